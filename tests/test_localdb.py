@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+import tsubodb.localdb
+from tsubodb.hash import ED2K_CHUNK_SIZE
+from tsubodb.localdb import LocalDB
+
+
+@pytest.fixture
+def hashed(monkeypatch):
+    '''Names of the files passed to hash_files'''
+    names = []
+    hash_files = tsubodb.localdb.hash_files
+
+    def recording_hash_files(files, *args, **kwargs):
+        names.extend(files)
+        return hash_files(files, *args, **kwargs)
+
+    monkeypatch.setattr(tsubodb.localdb, 'hash_files', recording_hash_files)
+    return names
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def restore(tmp_path, data):
+    '''Import a file, then replace it by a copy at another path (so with a new inode) with the given contents'''
+    db = LocalDB(str(tmp_path / 'tsubodb.db'), str(tmp_path / 'anime'), None)
+    old = str(tmp_path / 'anime' / 'a' / 'ep1.mkv')
+    new = str(tmp_path / 'anime' / 'b' / 'ep1.mkv')
+    write(old, data)
+    [original] = db.get_local_files([old])
+    db.commit()
+    write(new, data)
+    os.remove(old)
+    return db, original, new
+
+
+def test_quick_hash_match_skips_hashing(tmp_path, hashed):
+    data = os.urandom(ED2K_CHUNK_SIZE + 1000)
+    db, original, new = restore(tmp_path, data)
+    del hashed[:]
+    [local] = db.get_local_files([new])
+    assert new not in hashed
+    assert (local.path, local.size, local.ed2k) == (os.path.join('b', 'ep1.mkv'), original.size, original.ed2k)
+    assert db.query.get_unverified_paths() == [local.path]
+
+    assert db.verify_quick_hash_matches() == []
+    assert hashed == [new]
+    assert db.query.get_unverified_paths() == []
+
+
+def test_wrong_quick_hash_match_is_replaced(tmp_path):
+    data = os.urandom(ED2K_CHUNK_SIZE + 1000)
+    db, original, new = restore(tmp_path, data)
+    # Same first chunk and size, different end
+    write(new, data[:-1] + bytes([data[-1] ^ 1]))
+    [local] = db.get_local_files([new])
+    assert local.ed2k == original.ed2k
+
+    [wrong] = db.verify_quick_hash_matches()
+    assert wrong.path == local.path and wrong.ed2k != original.ed2k
+    assert db.query.get_local_file_from_path(local.path).ed2k == wrong.ed2k
+    assert db.query.get_unverified_paths() == []
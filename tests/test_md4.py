@@ -0,0 +1,65 @@
+import hashlib
+import os
+
+import pytest
+
+pytest.importorskip('numpy')
+
+import tsubodb.hash
+from tsubodb import md4
+from tsubodb.hash import Ed2k, Hash
+
+# RFC 1320 test suite
+RFC_VECTORS = {
+    b'': '31d6cfe0d16ae931b73c59d7e0c089c0',
+    b'a': 'bde52cb31de33e46245e05fbdbd6fb24',
+    b'abc': 'a448017aaf21d8525fc10ae87aa6729d',
+    b'message digest': 'd9130a8164549fe818874806e1c7014b',
+    b'abcdefghijklmnopqrstuvwxyz': 'd79e1c308aa5bbcdeea8ed63df412da9',
+    b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789': '043f8582f241db351ce627e153e7f0e4',
+    b'1234567890' * 8: 'e33b4ddc9c38f2199c3e7b164fcc0536',
+}
+
+# Lengths either side of the 56 and 64 byte padding boundaries
+LENGTHS = [0, 1, 55, 56, 63, 64, 65, 119, 120, 128, 1000]
+
+
+def hashlib_md4(data):
+    try:
+        h = hashlib.new('md4')
+    except ValueError:
+        pytest.skip('hashlib has no md4')
+    h.update(data)
+    return h.digest()
+
+
+def test_md4_many_rfc_vectors():
+    messages = list(RFC_VECTORS)
+    assert [d.hex() for d in md4.md4_many(messages)] == list(RFC_VECTORS.values())
+
+
+def test_md4_many_matches_hashlib():
+    messages = [os.urandom(length) for length in LENGTHS]
+    assert md4.md4_many(messages) == [hashlib_md4(m) for m in messages]
+
+
+@pytest.mark.parametrize('size_chunks', [0.5, 1, 4.3])
+def test_lockstep_ed2k_matches_ed2k(tmp_path, monkeypatch, size_chunks):
+    # Small chunks keep the numpy md4 quick, and a small budget splits them into several groups of lanes
+    chunk_size = 1000
+    block_size = 128
+    monkeypatch.setattr(tsubodb.hash, 'ED2K_CHUNK_SIZE', chunk_size)
+    monkeypatch.setattr(md4, 'SLAB_BUDGET', 2 * block_size)
+    data = os.urandom(int(size_chunks * chunk_size))
+    path = tmp_path / 'file'
+    path.write_bytes(data)
+
+    h = Ed2k()
+    h.update(data)
+    digests = Hash._lockstep_chunk_digests(str(path), len(data), block_size, [], None)
+    assert Ed2k.combine(digests) == h.hexdigest()
+
+
+def test_max_lanes_fits_budget():
+    assert md4.max_lanes(tsubodb.hash.DEFAULT_BLOCK_SIZE) * tsubodb.hash.DEFAULT_BLOCK_SIZE <= md4.SLAB_BUDGET
+    assert md4.max_lanes(md4.SLAB_BUDGET * 2) == 1
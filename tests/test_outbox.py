@@ -0,0 +1,51 @@
+import os
+import threading
+
+import pytest
+
+from tsubodb.api import AniDB
+from tsubodb.devserver import DevServer
+from tsubodb.localdb import LocalDB
+from tsubodb.ratelimit import FixedIntervalLimiter
+from tsubodb.types import *
+
+
+FILE_INFO = {'fid': 5, 'eid': 50, 'aid': 500, 'english': 'a', 'romaji': 'a', 'kanji': 'a', 'epno': '1', 'epname': 'e',
+             'epromaji': 'e', 'epkanji': 'e'}
+
+
+@pytest.fixture
+def server():
+    with DevServer(ban_interval=0) as server:
+        yield server
+
+
+def make_db(tmp_path, server, username):
+    anidb = AniDB(username, lambda: 'password', 0, server.address, rate_limiter=FixedIntervalLimiter(0))
+    db = LocalDB(os.path.join(tmp_path, 'tsubodb.db'), str(tmp_path), anidb)
+    db.query.insert_file_from_anidb(FILE_INFO)
+    return db
+
+
+def test_flushed_without_a_session(tmp_path, server):
+    db = make_db(tmp_path, server, lambda: 'user')
+    assert not db.anidb.session
+    db.mark_watched(Fid(5))
+    assert db.stop_outbox(10) == 0
+    assert [entry[7] > 0 for entry in server.state.mylist.values()] == [True]
+    assert db.query.get_mylist_from_fid(Fid(5)).lid > 0
+
+
+def test_flushed_after_main_thread_login(tmp_path, server):
+    def username():
+        # Like tsubodb.py when the username has to be asked for
+        if threading.current_thread() is not threading.main_thread():
+            raise AniDBLoginError('No username to log in with')
+        return 'user'
+
+    db = make_db(tmp_path, server, username)
+    db.mark_watched(Fid(5))
+    db.outbox.join(1)
+    assert db.query.count_outbox() == 1
+    assert db.stop_outbox(10) == 0
+    assert [entry[7] > 0 for entry in server.state.mylist.values()] == [True]
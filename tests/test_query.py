@@ -0,0 +1,22 @@
+import sqlite3
+
+from tsubodb._query import _Query
+from tsubodb.types import Aid
+
+
+def insert_files(query, aid, epnos):
+    for i, epno in enumerate(epnos):
+        fid = aid * 1000 + i
+        query.insert_file_from_anidb({'fid': fid, 'eid': fid, 'aid': aid, 'english': '', 'romaji': '', 'kanji': '',
+                                      'epno': epno, 'epname': '', 'epromaji': '', 'epkanji': ''})
+
+
+def test_epnomax_padded_like_epno():
+    query = _Query(sqlite3.connect(':memory:'))
+    query.init_db()
+    insert_files(query, 1, ['01', '02', '12', 'S01', 'S02'])
+    insert_files(query, 2, ['001', '100'])
+
+    assert query.get_playnext_for_episode(Aid(1), '', 1).epnomax == '12'
+    assert query.get_playnext_for_episode(Aid(1), 'S', 1).epnomax == 'S02'
+    assert query.get_playnext_for_episode(Aid(2), '', 1).epnomax == '100'
@@ -0,0 +1,40 @@
+import pytest
+
+from tsubodb.ratelimit import AniDBRateLimiter, RateLimiter, TokenBucket
+
+
+def test_rate_limiter_is_abstract():
+    with pytest.raises(TypeError):
+        RateLimiter()
+
+
+def test_burst_one_spaces_packets():
+    bucket = TokenBucket(1, 2.0)
+    assert [bucket.take(1000.0) for _ in range(4)] == [0.0, 2.0, 4.0, 6.0]
+
+
+def test_refill():
+    bucket = TokenBucket(3, 2.0)
+    assert [bucket.take(1000.0) for _ in range(4)] == [0.0, 0.0, 0.0, 2.0]
+    # The token taken early is paid back first, then one more per interval up to the capacity
+    assert bucket.take(1004.0) == 0.0
+    assert bucket.take(1100.0) == 0.0
+    assert bucket.tokens == 2
+
+
+def test_clock_going_backwards_adds_nothing():
+    bucket = TokenBucket(1, 2.0)
+    assert bucket.take(1000.0) == 0.0
+    assert bucket.take(900.0) == 2.0
+
+
+def test_anidb_limiter_drops_to_long_term_rate():
+    limiter = AniDBRateLimiter(burst=1, sustain=3)
+    now = 1000.0
+    delays = []
+    for _ in range(10):
+        delay = limiter._reserve(now)
+        delays.append(delay)
+        now += delay
+    # The long term bucket refills a little during each 2 second gap, so it runs out after a few more than sustain
+    assert delays == [0.0] + [2.0] * 4 + [4.0] * 5
@@ -4,9 +4,13 @@
 import argparse
 import configparser
 import getpass
+import logging
 import os
 import subprocess
 import sys
+import threading
+
+from typing import List
 
 try:
     import argcomplete
@@ -14,8 +18,13 @@ except ImportError:
     argcomplete = None
 
 import tsubodb.api
+import tsubodb.cache
 import tsubodb.hash
 import tsubodb.localdb
+import tsubodb.netstats
+import tsubodb.outbox
+import tsubodb.ratelimit
+import tsubodb.watch
 from tsubodb.types import *
 
 
@@ -78,10 +87,41 @@ def main() -> None:
 
     parser.add_argument('--scan', help='Scan dir for new files, and import them. Defaults to anime-dir, or specify a single sub-dir (either absolute, or relative to anime-dir).',
                         action='append', nargs='?', const=None, default=[])
+    parser.add_argument('--hash-threads', help='Number of files to hash in parallel when scanning.', type=int,
+                        default=int(config.get('hash-threads', tsubodb.hash.DEFAULT_HASH_THREADS)))
+    parser.add_argument('--chunk-threads', help='Number of threads hashing chunks of a single large file in parallel.', type=int,
+                        default=int(config.get('chunk-threads', 1)))
+    parser.add_argument('--hash-block-size', help='Size in bytes of each read while hashing.', type=int,
+                        default=int(config.get('hash-block-size', tsubodb.hash.DEFAULT_BLOCK_SIZE)))
+    parser.add_argument('--readers-per-device', help='Maximum files hashed at once from each disk (0 for no limit, more can help on SSDs).', type=int,
+                        default=int(config.get('readers-per-device', tsubodb.hash.DEFAULT_READERS_PER_DEVICE)))
+    parser.add_argument('--small-first', help='Hash the smallest files first, so they are identified sooner.', action='store_true',
+                        default=config.get('small-first', '').lower() in ('1', 'yes', 'true', 'on'))
+    parser.add_argument('--full-scan', help='List every directory when scanning, even those unchanged since the last scan.', action='store_true')
+    parser.add_argument('--scan-threads', help='Number of directories to list in parallel when scanning.', type=int,
+                        default=int(config.get('scan-threads', 8)))
+    parser.add_argument('--watch', help='Keep running, and import new files in anime-dir as soon as they have finished being written (Linux only).',
+                        action='store_true')
+    parser.add_argument('--watch-settle', help='Seconds a new file must be left untouched before importing it in --watch mode.',
+                        type=float, default=float(config.get('watch-settle', tsubodb.watch.DEFAULT_SETTLE)))
+    parser.add_argument('--rate-limit-burst', help='AniDB requests sent without waiting after a break.', type=int,
+                        default=int(config.get('rate-limit-burst', tsubodb.ratelimit.DEFAULT_BURST)))
+    parser.add_argument('--rate-limit-state', help='File recording recent AniDB requests, so separate runs share the rate limit.',
+                        default=config.get('rate-limit-state', os.path.join(os.path.dirname(CONFIG_FILE_PATH), 'ratelimit.json')))
+    parser.add_argument('--cache-file', help='File caching AniDB replies, so repeated requests cost no packets.',
+                        default=config.get('cache-file', os.path.join(os.path.dirname(CONFIG_FILE_PATH), 'cache.db')))
+    parser.add_argument('--no-cache', help='Clear the cache of AniDB replies, so everything is fetched again.', action='store_true')
+    parser.add_argument('--session-file', help='File keeping the AniDB session between runs, so each run does not need to log in again.',
+                        default=config.get('session-file', os.path.join(os.path.dirname(CONFIG_FILE_PATH), 'session.json')))
+    parser.add_argument('--logout', help='End the saved AniDB session.', action='store_true')
+    parser.add_argument('--stats', metavar='FILE', help='Write counts and timings of the AniDB requests made to FILE (as JSON) at exit.',
+                        default=config.get('stats'))
+    parser.add_argument('-v', '--verbose', help='Show every packet sent to and received from AniDB.', action='store_true')
     parser.add_argument('-w', '--watched', help='Mark scanned files watched.', action='store_true')
     parser.add_argument('--force-rehash', help='Force rehashing files for scan.', action='store_true')
     parser.add_argument('--force-recheck', help='Force rechecking with anidb files for scan (use after adding files to anidb through Avdump2)', action='store_true')
     parser.add_argument('--fill-database', help='Fill any missing files or Mylists', action='store_true')
+    parser.add_argument('--import-mylist', metavar='FILE', help='Load a MyList export from the AniDB website (CSV/TSV, or a .tgz/.zip of one), before any --fill-*.')
     parser.add_argument('--fill-mylist', help='Get/Add MyList for all files.', action='store_true')
 
     parser.add_argument('--vote', metavar='AID', help='Rate an anime by aid.')
@@ -96,41 +136,56 @@ def main() -> None:
     global language
     language = args.language
 
+    logging.basicConfig(format='%(message)s', level=logging.DEBUG if args.verbose else logging.WARNING)
+
     if not args.suffix:
         args.suffix = ['avi', 'ogm', 'mkv', 'mp4']
 
     def get_username() -> str:
         if not args.username:
+            if threading.current_thread() is not threading.main_thread():
+                # Background threads (the MyList outbox) can't ask, the prompt would fight the main thread for the terminal
+                raise tsubodb.types.AniDBLoginError('No username to log in with')
             args.username = input('Username: ')
         username: str = args.username
         return username
 
     def get_password() -> str:
         if not args.password:
+            if threading.current_thread() is not threading.main_thread():
+                raise tsubodb.types.AniDBLoginError('No password to log in with')
             args.password = getpass.getpass()
         password: str = args.password
         return password
 
+    rate_limiter = tsubodb.ratelimit.AniDBRateLimiter(args.rate_limit_burst, state_file=args.rate_limit_state)
+    cache = tsubodb.cache.ResponseCache(args.cache_file)
+    if args.no_cache:
+        cache.clear()
+    stats = tsubodb.netstats.NetStats()
+    anidb = tsubodb.api.AniDB(get_username, get_password, rate_limiter=rate_limiter, cache=cache, session_file=args.session_file,
+                              stats=stats)
+    db = tsubodb.localdb.LocalDB(args.database_file, args.anime_dir, anidb)
+    # Sends MyList changes (including any left from the last run) without holding anything else up
+    db.start_outbox()
+
     # Input files.
 
     files = []
 
-    for path in args.scan:
-        # TODO this can cause bad paths to go into database (../../../.. prefix)
-        if path is None:
-            path = args.anime_dir
-        elif not os.path.isabs(path):
-            path = os.path.join(args.anime_dir, path)
-        for dirpath, _dirnames, filenames in os.walk(path, onerror=print):
-            for file in filenames:
-                if any(file.endswith('.' + suffix) for suffix in args.suffix):
-                    files.append(os.path.join(dirpath, file))
-
-    anidb = tsubodb.api.AniDB(get_username, get_password)
-    db = tsubodb.localdb.LocalDB(args.database_file, args.anime_dir, anidb)
-
     if args.scan:
-        files = [x for x in files if args.force_rehash or args.force_recheck or not db.is_file_known(x)]
+        scan_paths = []
+        for path in args.scan:
+            # TODO this can cause bad paths to go into database (../../../.. prefix)
+            if path is None:
+                path = args.anime_dir
+            elif not os.path.isabs(path):
+                path = os.path.join(args.anime_dir, path)
+            scan_paths.append(path)
+        full_scan = args.full_scan or args.force_rehash or args.force_recheck
+        files = db.scan_directories(scan_paths, args.suffix, full_scan, args.scan_threads)
+        if not (args.force_rehash or args.force_recheck):
+            files = db.filter_unknown_files(files)
 
     files = sorted(files)
 
@@ -145,32 +200,28 @@ def main() -> None:
             if args.force_recheck:
                 db.force_recheck(files)
 
-            for file in db.get_local_files(files):
-                print(f'{blue("File:")} {file}')
-
-                try:
-                    # Get file, and if new add to mylist
-                    info = db.get_file(file)
-                    if not info:
-                        print(f'{red("Unknown:")} {file}')
-                        unknown_files.append(file)
-                        continue
-
-                    print(f'{green("Identified:")} {info.aname_k} - {info.epno} - {info.epname_k}')
+            unknown_files = import_files(db, files, args)
+            if db.saved_requests:
+                print(f'{green("Saved")} {db.saved_requests} AniDB requests by reusing replies for duplicate files')
 
-                    # Watched.
-                    if args.watched:
-                        db.mark_watched(info.fid)
-                        print(green('Marked watched.'))
+        if files or args.scan:
+            # Files matched by quick hash were imported without reading all of them, so check them now (or any
+            # left unchecked by an earlier run)
+            wrong = db.verify_quick_hash_matches(args.hash_threads, args.chunk_threads, args.hash_block_size,
+                                                 args.readers_per_device)
+            if wrong:
+                unknown_files += import_files(db, [os.path.join(db.base_anime_folder, local.path) for local in wrong], args)
 
-                    if args.fetch_mylist:
-                        db.fetch_mylist(info.fid)
+        if args.scan:
+            # Everything found has been imported, so these directories don't need listing next time if unchanged
+            db.save_scanned_directories()
 
-                except tsubodb.types.AniDBUnknownFile:
-                    print(red('Unknown file.'))
-
-                except tsubodb.types.AniDBNotInMylist:
-                    print(red('File not in mylist.'))
+        if args.import_mylist:
+            try:
+                total, changed = db.import_mylist_export(args.import_mylist)
+                print(f'{green("Imported MyList:")} {total} entries, {changed} new or changed')
+            except (OSError, ValueError) as e:
+                print(f'{red("Cannot import MyList:")} {e}')
 
         if args.fill_database:
             db.fill_files()
@@ -183,12 +234,22 @@ def main() -> None:
             aid = Aid(int(args.vote))
             prompt_rate_anime(anidb, aid)
 
+        if args.watch or args.playnext or args.play:
+            # These can sit idle for a long time (waiting for files, or while a video plays)
+            anidb.start_keepalive()
+
+        if args.watch:
+            run_watch(db, args)
+
         if args.playnext:
             run_playnext(args.video_player, db, anidb, True)
 
         if args.play:
             run_playnext(args.video_player, db, anidb, False)
 
+        if args.logout:
+            anidb.logout()
+
     except tsubodb.types.AniDBUserError:
         print(red('Invalid username/password.'))
         sys.exit(1)
@@ -198,6 +259,18 @@ def main() -> None:
     except tsubodb.types.AniDBError as err:
         print('{0} {1}'.format(red('Fatal error:'), err))
         sys.exit(1)
+    finally:
+        queued = db.stop_outbox(tsubodb.outbox.STOP_TIMEOUT)
+        if queued:
+            print(f'{queued} MyList changes not yet sent to AniDB, they will be sent next time')
+        if args.stats:
+            try:
+                stats.dump(args.stats)
+            except OSError as e:
+                print(f'{red("Cannot write stats:")} {e}')
+
+    if rate_limiter.waited:
+        print(f'Waited {rate_limiter.waited:.1f}s for the AniDB rate limit ({rate_limiter.packets} requests)')
 
     if unknown_files:
         print(red(f'{len(unknown_files)} unknown files:'))
@@ -205,6 +278,64 @@ def main() -> None:
             print(unk.path)
         print(red(f'{len(unknown_files)} unknown files'))
 
+def import_files(db: tsubodb.localdb.LocalDB, files: List[str], args: argparse.Namespace) -> List[LocalFileInfo]:
+    '''Hash files, identify them with AniDB and add them to mylist. Returns the files AniDB doesn't know'''
+    unknown_files = []
+    # Hashing, AniDB lookups and DB writes overlap, so files are reported as each finishes
+    for file, info, error in db.import_files(files, args.hash_threads, args.chunk_threads, args.hash_block_size,
+                                             args.readers_per_device, args.small_first):
+        print(f'{blue("File:")} {file}')
+
+        try:
+            if error:
+                raise error
+
+            if not info:
+                print(f'{red("Unknown:")} {file}')
+                unknown_files.append(file)
+                continue
+
+            print(f'{green("Identified:")} {info.aname_k} - {info.epno} - {info.epname_k}')
+
+            # Watched.
+            if args.watched:
+                db.mark_watched(info.fid)
+                print(green('Marked watched.'))
+
+            if args.fetch_mylist:
+                db.fetch_mylist(info.fid)
+
+        except tsubodb.types.AniDBUnknownFile:
+            print(red('Unknown file.'))
+
+        except tsubodb.types.AniDBNotInMylist:
+            print(red('File not in mylist.'))
+    return unknown_files
+
+def run_watch(db: tsubodb.localdb.LocalDB, args: argparse.Namespace) -> None:
+    '''Import new files in anime-dir as soon as they've finished being written, until ctrl-c'''
+    try:
+        watcher = tsubodb.watch.DirectoryWatcher(db.base_anime_folder, args.suffix, args.watch_settle)
+    except OSError as e:
+        print(f'{red("Cannot watch for new files:")} {e}')
+        return
+    print(f'{blue("Watching")} {db.base_anime_folder} for new files (ctrl-c to stop)')
+    try:
+        while True:
+            ready = watcher.poll()
+            if not ready:
+                continue
+            files = db.filter_unknown_files(ready)
+            if not files:
+                continue
+            # import_files reports the files AniDB doesn't know
+            import_files(db, files, args)
+            db.commit()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
 def prompt_rate_anime(anidb: tsubodb.api.AniDB, aid: Aid) -> None:
     while True:
         try:
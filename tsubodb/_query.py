@@ -4,22 +4,120 @@ import sqlite3
 
 from tsubodb.types import *
 
-from typing import Dict, Iterator, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+def split_epno(epno: str) -> Tuple[str, int]:
+    '''
+    Episode type code (e.g. 'S' for specials, '' for regular episodes) and number of an AniDB epno
+    'S02' -> ('S', 2), '10' -> ('', 10)
+    '''
+    code = epno[:1] if epno[:1].isalpha() else ''
+    number = epno[len(code):]
+    return code, int(number) if number.isdigit() else 0
+
+
+# Recalculate the SeriesProgress rows of the (aid, epcode) pairs selected by {groups}
+_DELETE_SERIES_PROGRESS = 'DELETE FROM SeriesProgress WHERE (aid, epcode) IN ({groups});'
+_INSERT_SERIES_PROGRESS = '''
+INSERT INTO SeriesProgress
+SELECT Files.aid, Files.epcode, MAX(Files.epnum), COUNT(DISTINCT LocalFiles.path),
+        COUNT(DISTINCT CASE WHEN MyList.viewdate != 0 THEN Files.fid END),
+        (
+            SELECT Next.fid
+            FROM Files AS Next
+            INNER JOIN MyList AS NextMyList USING(fid)
+            WHERE Next.aid = Files.aid AND Next.epcode = Files.epcode AND NextMyList.viewdate = 0
+            ORDER BY Next.epnum, Next.fid
+            LIMIT 1
+        )
+FROM Files
+LEFT JOIN LocalFiles USING(fid)
+LEFT JOIN MyList USING(fid)
+WHERE (Files.aid, Files.epcode) IN ({groups})
+GROUP BY Files.aid, Files.epcode;
+'''
 
 
 class _Query:
     def __init__(self, conn: sqlite3.Connection):
         self.conn = conn
+        # So the SeriesProgress triggers also see the rows INSERT OR REPLACE deletes
+        self.conn.execute('PRAGMA recursive_triggers = ON')
+
+    def insert_local_file(self, path: DbRelPath, size: int, ed2k: HashStr, fid: Fid=Fid(0), checked: bool=False) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO LocalFiles VALUES(?, ?, ?, ?, ?)', [path, size, ed2k, fid, int(checked)])
+
+    def insert_file_stat(self, dev: int, inode: int, size: int, mtime_ns: int, path: DbRelPath) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO FileStats VALUES(?, ?, ?, ?, ?)', [dev, inode, size, mtime_ns, path])
+
+    def get_path_from_stat(self, dev: int, inode: int, size: int, mtime_ns: int) -> Optional[DbRelPath]:
+        row = self.conn.execute('SELECT path FROM FileStats WHERE dev = ? AND inode = ? AND size = ? AND mtime_ns = ?',
+                                [dev, inode, size, mtime_ns]).fetchone()
+        if row:
+            return DbRelPath(row[0])
+        return None
+
+    def insert_quick_hash(self, path: DbRelPath, size: int, quickhash: HashStr, verified: bool=True) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO QuickHashes VALUES(?, ?, ?, ?)', [path, size, quickhash, int(verified)])
+
+    def get_quick_hash(self, path: DbRelPath) -> Optional[Tuple[HashStr, bool]]:
+        row = self.conn.execute('SELECT quickhash, verified FROM QuickHashes WHERE path = ?', [path]).fetchone()
+        if row:
+            return HashStr(row[0]), bool(row[1])
+        return None
+
+    def get_quick_hashes_for_size(self, size: int) -> List[Tuple[DbRelPath, HashStr]]:
+        rows = self.conn.execute('SELECT path, quickhash FROM QuickHashes WHERE size = ?', [size]).fetchall()
+        return [(DbRelPath(row[0]), HashStr(row[1])) for row in rows]
+
+    def get_unverified_paths(self) -> List[DbRelPath]:
+        '''Paths matched to a moved file by quick hash alone, that still need a full hash to confirm'''
+        rows = self.conn.execute('SELECT path FROM QuickHashes WHERE verified = 0').fetchall()
+        return [DbRelPath(row[0]) for row in rows]
 
-    def insert_local_file(self, path: DbRelPath, size: int, ed2k: HashStr) -> None:
-        self.conn.execute('INSERT OR REPLACE INTO LocalFiles VALUES(?, ?, ?, 0, 0)', [path, size, ed2k])
+    def insert_hash_checkpoint(self, path: DbRelPath, size: int, mtime_ns: int, offset: int, digests: bytes) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO HashCheckpoints VALUES(?, ?, ?, ?, ?)', [path, size, mtime_ns, offset, digests])
+
+    def get_hash_checkpoint(self, path: DbRelPath, size: int, mtime_ns: int) -> Optional[bytes]:
+        row = self.conn.execute('SELECT digests FROM HashCheckpoints WHERE path = ? AND size = ? AND mtime_ns = ?',
+                                [path, size, mtime_ns]).fetchone()
+        if row:
+            return bytes(row[0])
+        return None
+
+    def delete_hash_checkpoint(self, path: DbRelPath) -> None:
+        self.conn.execute('DELETE FROM HashCheckpoints WHERE path = ?', [path])
+
+    def get_directories(self) -> Iterator[Tuple[DbRelPath, int, int, List[str]]]:
+        c = self.conn.cursor()
+        for row in c.execute('SELECT * FROM Directories'):
+            yield DbRelPath(row[0]), row[1], row[2], row[3].split('/') if row[3] else []
+        c.close()
+
+    def insert_directory(self, path: DbRelPath, mtime_ns: int, entries: int, subdirs: List[str]) -> None:
+        # '/' can't appear in a file name, so use it to separate the subdirectory names
+        self.conn.execute('INSERT OR REPLACE INTO Directories VALUES(?, ?, ?, ?)', [path, mtime_ns, entries, '/'.join(subdirs)])
+
+    def delete_directories(self) -> None:
+        self.conn.execute('DELETE FROM Directories')
+
+    def get_setting(self, key: str) -> Optional[str]:
+        row = self.conn.execute('SELECT value FROM Settings WHERE key = ?', [key]).fetchone()
+        if row:
+            return str(row[0])
+        return None
+
+    def set_setting(self, key: str, value: str) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO Settings VALUES(?, ?)', [key, value])
 
     def insert_file_from_anidb(self, info: Dict[str, str]) -> None:
+        epcode, epnum = split_epno(info['epno'])
         self.conn.execute(
 '''
 INSERT OR REPLACE INTO Files
-VALUES(:fid, :eid, :aid, :english, :romaji, :kanji, :epno, :epname, :epromaji, :epkanji)
-''', info)
+VALUES(:fid, :eid, :aid, :english, :romaji, :kanji, :epno, :epname, :epromaji, :epkanji, :epcode, :epnum)
+''', dict(info, epcode=epcode, epnum=epnum))
 
     def insert_mylist(self, mylist: MyList) -> None:
         self.conn.execute(
@@ -28,24 +126,106 @@ INSERT OR REPLACE INTO MyList
 VALUES(:lid, :fid, :eid, :aid, :gid, :date, :state, :viewdate)
 ''', mylist.__dict__)
 
+    def insert_mylists(self, mylists: Iterable[MyList]) -> None:
+        self.conn.executemany(
+'''
+INSERT OR REPLACE INTO MyList
+VALUES(:lid, :fid, :eid, :aid, :gid, :date, :state, :viewdate)
+''', (mylist.__dict__ for mylist in mylists))
+
+    def get_all_mylist(self) -> Dict[Lid, MyList]:
+        return {Lid(row[0]): MyList(*row) for row in self.conn.execute('SELECT * FROM MyList')}
+
     def mylist_mark_watched(self, mylist: MyList) -> None:
         timestamp = int(time.time())
         self.conn.execute('UPDATE Mylist SET viewdate = ? WHERE lid = ?', [timestamp, mylist.lid])
 
+    def insert_mylist_placeholder(self, fid: Fid) -> MyList:
+        '''
+        Watched MyList entry for fid until AniDB adds the real one
+        Its lid is -fid, as the real lid isn't known yet
+        '''
+        now = int(time.time())
+        row = self.conn.execute('SELECT eid, aid FROM Files WHERE fid = ?', [fid]).fetchone()
+        eid, aid = row if row else (0, 0)
+        mylist = MyList(Lid(-fid), fid, Eid(eid), Aid(aid), Gid(0), now, 1, now)
+        self.insert_mylist(mylist)
+        return mylist
+
+    def replace_mylist_placeholder(self, mylist: MyList) -> None:
+        self.conn.execute('DELETE FROM MyList WHERE lid = ?', [-int(mylist.fid)])
+        self.insert_mylist(mylist)
+
+    def insert_outbox(self, kind: str, fid: Fid, lid: Optional[Lid]=None) -> None:
+        # Already queued changes to the same file are the same change, so only one is kept
+        self.conn.execute('INSERT OR IGNORE INTO Outbox(kind, fid, lid, created) VALUES(?, ?, ?, ?)',
+                          [kind, fid, lid, time.time()])
+
+    def get_outbox(self) -> List[Tuple[int, str, Fid, Optional[Lid]]]:
+        rows = self.conn.execute('SELECT id, kind, fid, lid FROM Outbox ORDER BY id').fetchall()
+        return [(row[0], row[1], Fid(row[2]), Lid(row[3]) if row[3] is not None else None) for row in rows]
+
+    def count_outbox(self) -> int:
+        return int(self.conn.execute('SELECT COUNT(*) FROM Outbox').fetchone()[0])
+
+    def delete_outbox(self, ids: Iterable[int]) -> None:
+        self.conn.executemany('DELETE FROM Outbox WHERE id = ?', ([i] for i in ids))
+
     def delete_local(self, path: DbRelPath) -> None:
-        self.conn.execute('DELETE FROM LocalFiles WHERE path LIKE ?', [path])
+        self.conn.execute('DELETE FROM LocalFiles WHERE path = ?', [path])
+        self.conn.execute('DELETE FROM FileStats WHERE path = ?', [path])
+        self.conn.execute('DELETE FROM QuickHashes WHERE path = ?', [path])
+        self.conn.execute('DELETE FROM HashCheckpoints WHERE path = ?', [path])
 
     def force_recheck(self, path: DbRelPath) -> None:
-        self.conn.execute('UPDATE LocalFiles SET checked = 0 WHERE path LIKE ?', [path])
+        self.conn.execute('UPDATE LocalFiles SET checked = 0 WHERE path = ?', [path])
 
     def get_local_file_from_path(self, path: DbRelPath) -> Optional[LocalFileInfo]:
-        row = self.conn.execute('SELECT * from LocalFiles WHERE path LIKE ?', [path]).fetchone()
+        row = self.conn.execute('SELECT * from LocalFiles WHERE path = ?', [path]).fetchone()
         if row:
             return LocalFileInfo(*row)
         return None
 
+    def _load_scan_paths(self, paths: Iterable[DbRelPath]) -> None:
+        # Temp table to join against, so a whole batch of paths is resolved in one indexed pass
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS ScanPaths ("path" TEXT PRIMARY KEY)')
+        self.conn.execute('DELETE FROM ScanPaths')
+        self.conn.executemany('INSERT OR IGNORE INTO ScanPaths VALUES(?)', [(p,) for p in paths])
+
+    def get_local_files_from_paths(self, paths: Iterable[DbRelPath]) -> Dict[DbRelPath, LocalFileInfo]:
+        self._load_scan_paths(paths)
+        rows = self.conn.execute('SELECT LocalFiles.* FROM ScanPaths INNER JOIN LocalFiles USING(path)').fetchall()
+        return {DbRelPath(row[0]): LocalFileInfo(*row) for row in rows}
+
+    def get_paths_without_file_stat(self) -> List[DbRelPath]:
+        '''Paths in LocalFiles that have no FileStats fingerprint'''
+        rows = self.conn.execute('''
+SELECT path
+FROM LocalFiles
+LEFT JOIN FileStats USING(path)
+WHERE FileStats.path IS NULL
+''').fetchall()
+        return [DbRelPath(row[0]) for row in rows]
+
+    def get_identified_fid(self, size: int, ed2k: HashStr) -> Optional[Fid]:
+        '''fid of an already identified file with this size and hash'''
+        row = self.conn.execute('''
+SELECT LocalFiles.fid
+FROM LocalFiles
+INNER JOIN Files USING(fid)
+WHERE LocalFiles.hash = ? AND LocalFiles.size = ? AND LocalFiles.checked = 1
+LIMIT 1
+''', [ed2k, size]).fetchone()
+        if row:
+            return Fid(row[0])
+        return None
+
     def get_file_from_local(self, local: LocalFileInfo) -> Optional[FileInfo]:
-        row = self.conn.execute('SELECT * from Files WHERE fid = ?', [local.fid]).fetchone()
+        row = self.conn.execute('''
+SELECT fid, eid, aid, aname_e, aname_r, aname_k, epno, epname_e, epname_r, epname_k
+FROM Files
+WHERE fid = ?
+''', [local.fid]).fetchone()
         if row:
             return FileInfo(local.path, local.size, local.ed2k, *row)
         return None
@@ -55,7 +235,7 @@ VALUES(:lid, :fid, :eid, :aid, :gid, :date, :state, :viewdate)
 '''
 UPDATE LocalFiles
 SET checked = 1, fid = ?
-WHERE path LIKE ?
+WHERE path = ?
 ''', [local.fid, local.path])
 
     def get_mylist_from_fid(self, fid: Fid) -> Optional[MyList]:
@@ -85,18 +265,18 @@ WHERE Mylist.date IS NULL
         row = self.conn.execute('''
 SELECT LocalEpisodeInfo.*
 FROM PlayNext
-LEFT JOIN LocalEpisodeInfo USING(aid, epno)
+INNER JOIN LocalEpisodeInfo USING(aid, epno)
 ''').fetchone()
         if row:
             return LocalEpisodeInfo(*row)
         return None
 
-    def get_playnext_for_episode(self, aid: Aid, epno: str) -> Optional[LocalEpisodeInfo]:
+    def get_playnext_for_episode(self, aid: Aid, epcode: str, epnum: int) -> Optional[LocalEpisodeInfo]:
         row = self.conn.execute('''
 SELECT *
 FROM LocalEpisodeInfo
-WHERE aid == ? AND epno REGEXP ?
-''', [aid, epno]).fetchone()
+WHERE aid == ? AND epcode == ? AND epnum == ?
+''', [aid, epcode, epnum]).fetchone()
         if row:
             return LocalEpisodeInfo(*row)
         return None
@@ -115,19 +295,14 @@ WHERE aid == ? AND epno REGEXP ?
         """
         c = self.conn.cursor()
         for row in c.execute('''
-SELECT LocalEpisodeInfo.*, MIN(epno) as epnomin,
-            CASE
-                WHEN epno GLOB '[A-Z]*' THEN
-                    substr(epno, 1, 1)
-                ELSE
-                    ''
-                END epcode
-FROM LocalEpisodeInfo
-WHERE NOT viewed AND epcode NOT LIKE "C" AND epcode NOT LIKE "T"
-GROUP BY aid, epcode
-ORDER BY aid ASC, epno ASC
+SELECT LocalEpisodeInfo.*
+FROM SeriesProgress
+INNER JOIN LocalEpisodeInfo ON LocalEpisodeInfo.fid = SeriesProgress.next_fid
+WHERE SeriesProgress.epcode NOT IN ('C', 'T')
+GROUP BY SeriesProgress.aid, SeriesProgress.epcode
+ORDER BY SeriesProgress.aid ASC, SeriesProgress.epcode ASC
 '''):
-            yield LocalEpisodeInfo(*row[:13])
+            yield LocalEpisodeInfo(*row)
         c.close()
 
     def init_db(self) -> None:
@@ -239,5 +414,173 @@ ORDER BY Files.aid, Files.epno;
 
             self.conn.execute('UPDATE Version SET ver=2')
 
+        if version < 3:
+            # Version 3, fingerprint of hashed files, so moved/renamed files can be recognised without rehashing
+            self.conn.execute('''
+CREATE TABLE IF NOT EXISTS "FileStats" (
+        "dev" INTEGER,
+        "inode" INTEGER,
+        "size" INTEGER,
+        "mtime_ns" INTEGER,
+        "path" TEXT UNIQUE,
+        PRIMARY KEY("dev", "inode", "size", "mtime_ns")
+);
+''')
+
+            self.conn.execute('UPDATE Version SET ver=3')
+
+        if version < 4:
+            # Version 4, progress through hashing large files, so an interrupted scan can resume
+            self.conn.execute('''
+CREATE TABLE IF NOT EXISTS "HashCheckpoints" (
+        "path" TEXT UNIQUE,
+        "size" INTEGER,
+        "mtime_ns" INTEGER,
+        "offset" INTEGER,
+        "digests" BLOB,
+        PRIMARY KEY("path")
+);
+''')
+
+            self.conn.execute('UPDATE Version SET ver=4')
+
+        if version < 5:
+            # Version 5, state of scanned directories, so unchanged ones don't need to be listed again
+            self.conn.execute('''
+CREATE TABLE IF NOT EXISTS "Directories" (
+        "path" TEXT UNIQUE,
+        "mtime_ns" INTEGER,
+        "entries" INTEGER,
+        "subdirs" TEXT,
+        PRIMARY KEY("path")
+);
+''')
+
+            self.conn.execute('UPDATE Version SET ver=5')
+
+        if version < 6:
+            # Version 6, size and md4 of the first chunk of hashed files, so a moved/restored file can be matched
+            # to a missing one without a full hash
+            self.conn.execute('''
+CREATE TABLE IF NOT EXISTS "QuickHashes" (
+        "path" TEXT UNIQUE,
+        "size" INTEGER,
+        "quickhash" TEXT,
+        "verified" INTEGER,
+        PRIMARY KEY("path")
+);
+''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS "QuickHashesSize" ON "QuickHashes" ("size")')
+
+            self.conn.execute('UPDATE Version SET ver=6')
+
+        if version < 7:
+            # Version 7, find other copies of a file by hash, so they can share one AniDB lookup
+            self.conn.execute('CREATE INDEX IF NOT EXISTS "LocalFilesHash" ON "LocalFiles" ("hash")')
+
+            self.conn.execute('UPDATE Version SET ver=7')
+
+        if version < 8:
+            # Version 8, MyList changes made locally that still have to be sent to AniDB
+            self.conn.execute('''
+CREATE TABLE IF NOT EXISTS "Outbox" (
+        "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+        "kind" TEXT,
+        "fid" INTEGER,
+        "lid" INTEGER,
+        "created" REAL,
+        UNIQUE("kind", "fid")
+);
+''')
+
+            self.conn.execute('UPDATE Version SET ver=8')
+
+        if version < 9:
+            # Version 9, episode type code and number of each file as columns, so they can be indexed and sorted
+            # numerically, and indexes for the other common lookups
+            self.conn.execute('ALTER TABLE Files ADD COLUMN "epcode" TEXT DEFAULT \'\'')
+            self.conn.execute('ALTER TABLE Files ADD COLUMN "epnum" INTEGER DEFAULT 0')
+            for fid, epno in self.conn.execute('SELECT fid, epno FROM Files').fetchall():
+                self.conn.execute('UPDATE Files SET epcode = ?, epnum = ? WHERE fid = ?', [*split_epno(epno or ''), fid])
+            self.conn.execute('CREATE INDEX IF NOT EXISTS "FilesEpisode" ON "Files" ("aid", "epcode", "epnum")')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS "MyListFid" ON "MyList" ("fid")')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS "LocalFilesFid" ON "LocalFiles" ("fid")')
+            self.conn.execute('DROP INDEX IF EXISTS "LocalFilesHash"')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS "LocalFilesHashSize" ON "LocalFiles" ("hash", "size")')
+
+            self.conn.execute('DROP VIEW IF EXISTS LocalEpisodeInfo')
+            self.conn.execute('''
+CREATE VIEW LocalEpisodeInfo AS
+SELECT Files.aid, Files.fid, path, aname_e, epname_e, aname_r, epname_r, aname_k, epname_k, epno,
+            Files.epcode, SQ.epnomax, MyList.viewdate != 0 AS viewed, Files.epnum
+FROM Files
+LEFT JOIN LocalFiles USING(fid)
+INNER JOIN
+    (
+        SELECT aid, epcode, printf('%s%0*d', epcode, MAX(length(epno)) - length(epcode), MAX(epnum)) AS epnomax
+        FROM Files
+        GROUP BY aid, epcode
+    ) AS SQ ON SQ.aid = Files.aid AND SQ.epcode = Files.epcode
+LEFT JOIN MyList on Files.fid = MyList.fid
+ORDER BY Files.aid, Files.epcode, Files.epnum;
+''')
+
+            self.conn.execute('UPDATE Version SET ver=9')
+
+        if version < 10:
+            # Version 10, progress through each series (aid + epcode), kept up to date by triggers, instead of
+            # grouping every file whenever it's needed
+            self.conn.execute('''
+CREATE TABLE IF NOT EXISTS "SeriesProgress" (
+        "aid" INTEGER,
+        "epcode" TEXT,
+        "epnomax" INTEGER,
+        "local_files" INTEGER,
+        "watched" INTEGER,
+        "next_fid" INTEGER,
+        PRIMARY KEY("aid", "epcode")
+);
+''')
+            self.conn.execute(_INSERT_SERIES_PROGRESS.format(groups='SELECT aid, epcode FROM Files'))
+            for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('UPDATE', 'OLD'), ('DELETE', 'OLD')):
+                for table, groups in (('Files', 'SELECT {row}.aid, {row}.epcode'),
+                                      ('LocalFiles', 'SELECT aid, epcode FROM Files WHERE fid = {row}.fid'),
+                                      ('MyList', 'SELECT aid, epcode FROM Files WHERE fid = {row}.fid')):
+                    groups = groups.format(row=row)
+                    self.conn.execute(f'''
+CREATE TRIGGER IF NOT EXISTS "{table}{event.title()}{row.title()}SeriesProgress" AFTER {event} ON "{table}"
+BEGIN
+{_DELETE_SERIES_PROGRESS.format(groups=groups)}
+{_INSERT_SERIES_PROGRESS.format(groups=groups).strip()}
+END;
+''')
+
+            self.conn.execute('DROP VIEW IF EXISTS LocalEpisodeInfo')
+            self.conn.execute('''
+CREATE VIEW LocalEpisodeInfo AS
+SELECT Files.aid, Files.fid, path, aname_e, epname_e, aname_r, epname_r, aname_k, epname_k, epno,
+            Files.epcode, printf('%s%0*d', Files.epcode, length(epno) - length(Files.epcode), SeriesProgress.epnomax) AS epnomax,
+            MyList.viewdate != 0 AS viewed, Files.epnum
+FROM Files
+LEFT JOIN LocalFiles USING(fid)
+INNER JOIN SeriesProgress USING(aid, epcode)
+LEFT JOIN MyList on Files.fid = MyList.fid
+ORDER BY Files.aid, Files.epcode, Files.epnum;
+''')
+
+            self.conn.execute('UPDATE Version SET ver=10')
+
+        if version < 11:
+            # Version 11, options that earlier runs' stored state depends on (e.g. the suffixes directories were scanned for)
+            self.conn.execute('''
+CREATE TABLE IF NOT EXISTS "Settings" (
+        "key" TEXT UNIQUE,
+        "value" TEXT,
+        PRIMARY KEY("key")
+);
+''')
+
+            self.conn.execute('UPDATE Version SET ver=11')
+
         self.conn.commit()
 
@@ -1,15 +1,35 @@
+import json
+import logging
+import os
 import socket
+import threading
 import time
+import zlib
 
 import typing
 from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
 
+from tsubodb.cache import ResponseCache
+from tsubodb.netstats import NetStats
+from tsubodb.ratelimit import AniDBRateLimiter, RateLimiter
 from tsubodb.types import *
 
 protover = 3
 client = 'tsubodb'
 clientver = 3
 
+# Packets sent and received are logged at DEBUG level
+log = logging.getLogger(__name__)
+
+# Largest possible UDP datagram, so no reply is ever truncated
+MAX_DATAGRAM = 65507
+
+# Seconds of inactivity after which AniDB ends a session
+SESSION_TIMEOUT = 30 * 60
+
+# Seconds between pings, to keep a NAT router from forgetting our port
+KEEPALIVE_INTERVAL = 5 * 60
+
 
 fmask = [
     '', 'aid', 'eid', 'gid', 'lid', 'otherepisodes', 'deprecated', 'state',
@@ -35,21 +55,164 @@ ApiResponse = Tuple[int, str, List[List[str]]]  # Api response code/code text/da
 ApiArgs = Dict[str, Any]  # Key/Value dict of args for an api call
 ApiArgsOp = Optional[ApiArgs]  # Key/Value dict of args for an api call
 
+
+def format_command(cmd: str, args: ApiArgs) -> Tuple[str, str]:
+    '''The datagram to send for a command, and a copy with the password hidden for printing'''
+    params = '&'.join(['{0}={1}'.format(*a) for a in args.items()])
+    if 'pass' in args:
+        paramsCen = params.replace(args['pass'], 'PASSWORD')
+    else:
+        paramsCen = params
+    return f'{cmd} {params}\n', f'{cmd} {paramsCen}'
+
+
+def decode_datagram(data: bytes) -> str:
+    '''Text of a reply, inflating it if compressed (sent with comp=1, marked by two leading zero bytes)'''
+    if data[:2] == b'\x00\x00':
+        try:
+            data = zlib.decompress(data[2:])
+        except zlib.error:
+            # Raw deflate stream, without the zlib header
+            data = zlib.decompress(data[2:], -zlib.MAX_WBITS)
+    return data.decode()
+
+
+def parse_response(data: str) -> Tuple[Optional[str], ApiResponse]:
+    '''
+    Split a reply into its tag and response code/code text/data
+    Tag is None for replies without one (errors AniDB sends before reading the tag)
+    '''
+    lines = data.split('\n')
+    tag = None
+    if not lines[0][:3].isdigit():
+        tag, lines[0] = lines[0].split(' ', 1)
+    code, text = lines[0].split(' ', 1)
+    responseData = [line.split('|') for line in lines[1:-1]]
+    return tag, (int(code), text, responseData)
+
+
+def file_args(file: LocalFileInfo, info_codes: Iterable[str]) -> Tuple[ApiArgs, List[str]]:
+    '''Args of a FILE request, and the info codes in the order AniDB returns them'''
+    args: ApiArgs
+    if file.fid > 0:
+        args = {'fid': file.fid}
+    else:
+        args = {'size': file.size, 'ed2k': file.ed2k}
+    info_codes = list(info_codes)
+    info_codes.sort(key=lambda x: masks[x])
+    info_codes.reverse()
+    info_code = sum([masks[code] for code in info_codes])
+    args.update({'fmask': f'{info_code >> 32:0{10}X}', 'amask': f'{info_code  & 0xffffffff:0{8}X}'})
+    return args, info_codes
+
 class AniDB:
-    def __init__(self, username: Callable[[], str], password: Callable[[], str], localport: int = 1234, server: Tuple[str, int]=('api.anidb.info', 9000)):
+    def __init__(self, username: Callable[[], str], password: Callable[[], str], localport: int = 1234, server: Tuple[str, int]=('api.anidb.info', 9000),
+            rate_limiter: Optional[RateLimiter]=None, cache: Optional[ResponseCache]=None, session_file: Optional[str]=None,
+            stats: Optional[NetStats]=None):
+        '''
+        session_file: where to keep the session between runs, instead of logging out at the end (and in again next time)
+        '''
+        self.session = ''
+        self.nat_port = ''  # Our port as seen by AniDB, the session is only valid from there
+        self.last_activity = 0.0
+        self.session_file = session_file
+        saved = self._load_session(session_file) if session_file else None
+        if saved:
+            localport = int(saved['localport'])
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.bind(('0.0.0.0', localport))
+        try:
+            self.sock.bind(('0.0.0.0', localport))
+        except OSError:
+            if not saved:
+                raise
+            # Port taken (by another instance?) so the saved session can't be used from here
+            saved = None
+            self.sock.bind(('0.0.0.0', 0))
         self.sock.settimeout(10)
+        if saved:
+            self.session = saved['session']
+            self.nat_port = saved['nat_port']
+            self.last_activity = float(saved['last_activity'])
+        self.keepalive_stop: Optional[threading.Event] = None
         self.username = username
         self.password = password
         self.server = server
-        self.session = ''
-        self.lasttime = 0.0
+        self.rate_limiter = rate_limiter or AniDBRateLimiter()
+        self.tag_count = 0
+        self.cache = cache
+        self.stats = stats or NetStats()
+        self.lock = threading.RLock()
 
     def __del__(self) -> None:
-        self.logout()
+        self.close()
+
+    def close(self) -> None:
+        if self.sock.fileno() < 0:
+            return
+        self.stop_keepalive()
+        if self.session_file:
+            self._save_session(self.session_file)
+        else:
+            self.logout()
         self.sock.close()
 
+    @staticmethod
+    def _load_session(path: str) -> Optional[Dict[str, Any]]:
+        '''The saved session, if it hasn't expired'''
+        try:
+            with open(path) as f:
+                saved: Dict[str, Any] = json.load(f)
+            if saved['session'] and time.time() - float(saved['last_activity']) < SESSION_TIMEOUT:
+                return saved
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f'Ignoring bad session file {path}: {e}')
+        return None
+
+    def _save_session(self, path: str) -> None:
+        state = {'session': self.session, 'nat_port': self.nat_port, 'localport': self.sock.getsockname()[1],
+                 'last_activity': self.last_activity}
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            # The session key is as good as the password until it expires, so only the user can read it
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+        except OSError as e:
+            print(f'Cannot save session file {path}: {e}')
+
+    def start_keepalive(self, interval: float=KEEPALIVE_INTERVAL) -> None:
+        '''Keep the session usable while idle in long-running modes, by pinging from a background thread'''
+        if self.keepalive_stop:
+            return
+        stop = self.keepalive_stop = threading.Event()
+
+        def run() -> None:
+            while not stop.wait(interval):
+                if self.session:
+                    self.keepalive()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop_keepalive(self) -> None:
+        if self.keepalive_stop:
+            self.keepalive_stop.set()
+            self.keepalive_stop = None
+
+    def keepalive(self) -> None:
+        '''
+        PING nat=1, which keeps our NAT mapping open so AniDB still sees us on the same port
+        If the port has changed anyway the session is no longer valid, so log in again when next needed
+        '''
+        try:
+            code, text, data = self.execute('PING', {'nat': 1}, retry=False)
+        except AniDBTimeout:
+            return
+        if code == 300 and data and self.nat_port and data[0][0] != self.nat_port:
+            self.session = ''
+
     def newver_msg(self) -> None:
         print('New version available.')
 
@@ -57,42 +220,54 @@ class AniDB:
         print('Connection timed out, retrying.')
 
     def execute(self, cmd: str, args: ApiArgsOp=None, retry: bool=True) -> ApiResponse:
-        if not args:
-            args = {}
-        if cmd not in ('PING', 'ENCRYPT', 'ENCODING', 'AUTH', 'VERSION'):
-            if not self.session:
-                self.auth()
-            args['s'] = self.session
-
-        retry_count = 0
-        while retry_count < 3:
-            params = '&'.join(['{0}={1}'.format(*a) for a in args.items()])
-            cmdData = f'{cmd} {params}\n'
-            if 'pass' in args:
-                paramsCen = params.replace(args['pass'], 'PASSWORD')
-            else:
-                paramsCen = params
-            print('>', cmd, paramsCen)
-            t = time.time()
-            if t < self.lasttime + 2:
-                time.sleep(self.lasttime + 2 - t)
-            self.lasttime = time.time()
-            self.sock.sendto(cmdData.encode(), 0, self.server)
-            try:
-                data = self.sock.recv(8192).decode().split('\n')
-                print('<', data)
-            except socket.timeout:
-                if retry:
-                    self.retry_msg()
-                    time.sleep(10 ** retry_count)
-                    retry_count += 1
-                else:
-                    raise AniDBTimeout()
-            else:
-                break
-        code, text = data[0].split(' ', 1)
-        responseData = [line.split('|') for line in data[1:-1]]
-        return (int(code), text, responseData)
+        # Requests can come from more than one thread, this keeps them (and auth) one at a time
+        with self.lock:
+            if not args:
+                args = {}
+            if self.cache:
+                # Before logging in, so a run that only needs cached replies sends nothing
+                cached = self.cache.get(cmd, args)
+                if cached:
+                    self.stats.request(cmd, cached=True)
+                    log.debug('> %s (cached)', format_command(cmd, args)[1])
+                    return cached
+            self.stats.request(cmd)
+            if cmd not in ('PING', 'ENCRYPT', 'ENCODING', 'AUTH', 'VERSION'):
+                if not self.session:
+                    self.auth()
+                args['s'] = self.session
+            # A reply to an earlier request that timed out can still arrive, the tag tells them apart
+            self.tag_count += 1
+            args['tag'] = tag = f't{self.tag_count}'
+            cmdData, cmdCen = format_command(cmd, args)
+
+            retry_count = 0
+            while retry_count < 3:
+                log.debug('> %s', cmdCen)
+                self.stats.sent(cmd, self.rate_limiter.wait(), retry=retry_count > 0)
+                sent = time.monotonic()
+                self.sock.sendto(cmdData.encode(), 0, self.server)
+                try:
+                    while True:
+                        data = decode_datagram(self.sock.recv(MAX_DATAGRAM))
+                        log.debug('< %s', data.split('\n'))
+                        reply_tag, response = parse_response(data)
+                        if reply_tag in (tag, None):
+                            self.stats.reply(cmd, response[0], time.monotonic() - sent)
+                            if 's' in args:
+                                self.last_activity = time.time()
+                            if self.cache:
+                                self.cache.put(cmd, args, response)
+                            return response
+                except socket.timeout:
+                    self.stats.timeout(cmd)
+                    if retry:
+                        self.retry_msg()
+                        time.sleep(10 ** retry_count)
+                        retry_count += 1
+                    else:
+                        raise AniDBTimeout()
+            raise AniDBTimeout()
 
     def ping(self) -> bool:
         try:
@@ -102,9 +277,16 @@ class AniDB:
 
     def auth(self) -> None:
         code, text, data = self.execute('AUTH', {'user': self.username(), 'pass': self.password(), 'protover': protover,
-                                                 'client': client, 'clientver': clientver, 'enc': 'utf8'})
+                                                 'client': client, 'clientver': clientver, 'enc': 'utf8', 'nat': 1,
+                                                 'comp': 1})
         if code in (200, 201):
-            self.session = text.split(' ', 1)[0]
+            # With nat=1 this is "{session} {ip}:{port} LOGIN ACCEPTED"
+            words = text.split(' ')
+            self.session = words[0]
+            self.nat_port = words[1].rsplit(':', 1)[1] if len(words) > 1 and ':' in words[1] else ''
+            self.last_activity = time.time()
+            if self.session_file:
+                self._save_session(self.session_file)
             if code == 201:
                 self.newver_msg()
         elif code == 500:
@@ -117,20 +299,13 @@ class AniDB:
             try:
                 self.execute('LOGOUT', {'s': self.session})
                 self.session = ''
+                if self.session_file:
+                    self._save_session(self.session_file)
             except AniDBError:
                 pass
 
     def get_file(self, file: LocalFileInfo, info_codes: Iterable[str]) -> ApiDict:
-        args: ApiArgs
-        if file.fid > 0:
-            args = {'fid': file.fid}
-        else:
-            args = {'size': file.size, 'ed2k': file.ed2k}
-        info_codes = list(info_codes)
-        info_codes.sort(key=lambda x: masks[x])
-        info_codes.reverse()
-        info_code = sum([masks[code] for code in info_codes])
-        args.update({'fmask': f'{info_code >> 32:0{10}X}', 'amask': f'{info_code  & 0xffffffff:0{8}X}'})
+        args, info_codes = file_args(file, info_codes)
         while 1:
             code, text, data = self.execute('FILE', args)
             if code == 220:
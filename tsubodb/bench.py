@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Hashing and scanning benchmarks
+
+Run with: python -m tsubodb.bench hash --output results.json
+Results from different commits can be compared with --compare old_results.json
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import tsubodb.hash
+from tsubodb import md4
+from tsubodb.api import AniDB
+from tsubodb.devserver import DevServer
+from tsubodb.localdb import LocalDB
+from tsubodb.ratelimit import FixedIntervalLimiter
+from tsubodb.hash import ED2K_CHUNK_SIZE, Ed2k, Hash, hash_files
+
+from typing import Any, Dict, List, Optional, Tuple
+
+
+# Known ed2k hashes of small inputs - a single chunk is plain md4, so these are the RFC 1320 test suite
+ED2K_VECTORS: List[Tuple[bytes, str]] = [
+    (b'', '31d6cfe0d16ae931b73c59d7e0c089c0'),
+    (b'a', 'bde52cb31de33e46245e05fbdbd6fb24'),
+    (b'abc', 'a448017aaf21d8525fc10ae87aa6729d'),
+    (b'message digest', 'd9130a8164549fe818874806e1c7014b'),
+    (b'abcdefghijklmnopqrstuvwxyz', 'd79e1c308aa5bbcdeea8ed63df412da9'),
+    (b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789', '043f8582f241db351ce627e153e7f0e4'),
+    (b'1234567890' * 8, 'e33b4ddc9c38f2199c3e7b164fcc0536'),
+]
+
+# Known ed2k hashes of files of zeros, either side of the chunk boundaries
+ED2K_ZERO_VECTORS: List[Tuple[int, str]] = [
+    (ED2K_CHUNK_SIZE - 1, 'ac44b93fc9aff773ab0005c911f8396f'),
+    (ED2K_CHUNK_SIZE, 'd7def262a127cd79096a108e7a9fc138'),
+    (ED2K_CHUNK_SIZE + 1, '06329e9dba1373512c06386fe29e3c65'),
+    (ED2K_CHUNK_SIZE * 2, '194ee9e4fa79b2ee9f8829284c466051'),
+    (ED2K_CHUNK_SIZE * 2 + 1, 'e57f824d28f69fe90864e17673668457'),
+]
+
+# Synthetic files for the throughput benchmark
+DEFAULT_SIZES = [1 << 20, ED2K_CHUNK_SIZE - 1, ED2K_CHUNK_SIZE + 1, ED2K_CHUNK_SIZE * 5 + 12345]
+
+# Read strategy name -> threads hashing the chunks of each file
+def read_strategies(chunk_threads: int) -> Dict[str, int]:
+    return {'sequential': 1, 'chunked': chunk_threads}
+
+
+def write_file(path: str, size: int, rng: Optional[random.Random]=None) -> None:
+    """Write size bytes of pseudo-random data (or zeros without rng)"""
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            block = min(remaining, 1 << 20)
+            f.write(rng.randbytes(block) if rng else bytes(block))
+            remaining -= block
+
+
+def make_files(directory: str, sizes: List[int], seed: int=0) -> List[str]:
+    rng = random.Random(seed)
+    files = []
+    for i, size in enumerate(sizes):
+        path = os.path.join(directory, f'bench_{i}_{size}.bin')
+        write_file(path, size, rng)
+        files.append(path)
+    return files
+
+
+def check_vectors(directory: str, strategies: Dict[str, int]) -> List[str]:
+    """Check every hashing path against the known vectors, returning a description of each failure"""
+    failures = []
+    for data, expected in ED2K_VECTORS:
+        h = Ed2k()
+        h.update(data)
+        if h.hexdigest() != expected:
+            failures.append(f'Ed2k({data!r}) = {h.hexdigest()}, expected {expected}')
+    for size, expected in ED2K_ZERO_VECTORS:
+        path = os.path.join(directory, f'zeros_{size}.bin')
+        write_file(path, size)
+        for name, chunk_threads in strategies.items():
+            for block_size in (4096, tsubodb.hash.DEFAULT_BLOCK_SIZE):
+                result = Hash(path, chunk_threads, block_size).ed2k
+                if result != expected:
+                    failures.append(f'{name} block_size={block_size} {size} zeros = {result}, expected {expected}')
+        os.remove(path)
+    return failures
+
+
+def bench_ed2k(block_sizes: List[int], size: int) -> List[Dict[str, Any]]:
+    """Ed2k throughput on data already in memory, so no I/O is measured"""
+    results = []
+    data = memoryview(random.Random(0).randbytes(size))
+    for block_size in block_sizes:
+        wall, cpu = time.perf_counter(), time.process_time()
+        h = Ed2k()
+        for pos in range(0, size, block_size):
+            h.update(data[pos:pos + block_size])
+        h.hexdigest()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        results.append({'bench': 'ed2k', 'block_size': block_size, 'bytes': size, 'seconds': wall,
+                        'cpu_seconds': cpu, 'mb_per_s': size / wall / 1e6})
+    return results
+
+
+def bench_hashing(files: List[str], block_sizes: List[int], workers: List[int],
+        strategies: Dict[str, int], per_device: int) -> List[Dict[str, Any]]:
+    """
+    hash_files throughput for each combination of block size, worker count and read strategy
+    The files are all on one device, so per_device caps the files read at once whatever the worker count
+    """
+    total = sum(os.path.getsize(f) for f in files)
+    reference = {f: Hash(f).ed2k for f in files}
+    results = []
+    for name, chunk_threads in strategies.items():
+        for num_threads in workers:
+            for block_size in block_sizes:
+                wall, cpu = time.perf_counter(), time.process_time()
+                hashes = {h.name: h.ed2k for h in hash_files(list(files), num_threads, chunk_threads, block_size,
+                                                             per_device=per_device)}
+                wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+                results.append({'bench': 'hash_files', 'strategy': name, 'workers': num_threads,
+                                'readers_per_device': per_device, 'chunk_threads': chunk_threads,
+                                'block_size': block_size, 'bytes': total,
+                                'seconds': wall, 'cpu_seconds': cpu, 'mb_per_s': total / wall / 1e6,
+                                'correct': hashes == reference})
+    return results
+
+
+def bench_md4(lanes: List[int], lane_size: int) -> List[Dict[str, Any]]:
+    """Throughput of the numpy md4 at several lane counts, against hashlib's md4 (OpenSSL) when available"""
+    results: List[Dict[str, Any]] = []
+    data = os.urandom(lane_size)
+    for count in lanes:
+        messages = [data] * count
+        if tsubodb.hash.HASHLIB_MD4:
+            start = time.perf_counter()
+            for m in messages:
+                hashlib.new('md4', m).digest()
+            elapsed = time.perf_counter() - start
+            results.append({'bench': 'md4', 'impl': 'openssl', 'lanes': count, 'mb_per_s': count * lane_size / elapsed / 1e6})
+        if md4.available():
+            start = time.perf_counter()
+            md4.md4_many(messages)
+            elapsed = time.perf_counter() - start
+            results.append({'bench': 'md4', 'impl': 'numpy', 'lanes': count, 'mb_per_s': count * lane_size / elapsed / 1e6})
+    return results
+
+
+def make_library(directory: str, num_files: int, dirs: int, size: int, seed: int=0) -> None:
+    """Synthetic anime library: num_files video files of around size bytes spread over dirs directories"""
+    rng = random.Random(seed)
+    for i in range(num_files):
+        folder = os.path.join(directory, f'Anime {i % dirs}')
+        os.makedirs(folder, exist_ok=True)
+        write_file(os.path.join(folder, f'Episode {i:05}.mkv'), rng.randint(size // 2, size), rng)
+
+
+def bench_scan(library: str, db_file: str, server: DevServer, interval: float, hash_threads: int,
+        per_device: int) -> Dict[str, Any]:
+    """
+    A full scan and import of library (as by tsubodb.py --scan) against server, twice: once from scratch, then
+    again with nothing new to do
+    """
+    anidb = AniDB(lambda: 'bench', lambda: 'bench', 0, server.address, rate_limiter=FixedIntervalLimiter(interval))
+    db = LocalDB(db_file, library, anidb)
+    result: Dict[str, Any] = {'bench': 'scan', 'interval': interval, 'workers': hash_threads,
+                              'readers_per_device': per_device, 'latency': server.latency, 'loss': server.loss}
+    for run in ('first', 'rescan'):
+        packets = server.total_packets
+        wall, cpu = time.perf_counter(), time.process_time()
+        imported = unknown = 0
+        # Retry messages (with --loss) would swamp the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            files = db.filter_unknown_files(db.scan_directories([library], ['mkv'], False, 8))
+            for _local, info, _error in db.import_files(files, hash_threads, per_device=per_device):
+                imported += 1
+                unknown += info is None
+            db.save_scanned_directories()
+            db.commit()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        packets = server.total_packets - packets
+        result[run] = {'files': imported, 'unknown': unknown, 'seconds': wall, 'cpu_seconds': cpu, 'packets': packets,
+                       'files_per_minute': imported / wall * 60, 'packets_per_file': packets / imported if imported else 0.0}
+    result['files_per_minute'] = result['first']['files_per_minute']
+    with contextlib.redirect_stdout(io.StringIO()):
+        anidb.close()
+    return result
+
+
+def _result_key(result: Dict[str, Any]) -> Tuple[Any, ...]:
+    return tuple(result.get(k) for k in ('bench', 'impl', 'lanes', 'strategy', 'workers', 'readers_per_device', 'chunk_threads',
+                                         'block_size', 'bytes', 'interval', 'latency', 'loss'))
+
+
+_UNITS = {'mb_per_s': 'MB/s', 'files_per_minute': 'files/min'}
+
+
+def compare(results: List[Dict[str, Any]], old_results: List[Dict[str, Any]]) -> None:
+    old = {_result_key(r): r for r in old_results}
+    for result in results:
+        previous = old.get(_result_key(result))
+        if previous:
+            unit = 'files_per_minute' if result['bench'] == 'scan' else 'mb_per_s'
+            change = result[unit] / previous[unit] - 1
+            print(f'{_describe(result)}: {previous[unit]:.2f} -> {result[unit]:.2f} {_UNITS[unit]} ({change:+.1%})')
+
+
+def _describe(result: Dict[str, Any]) -> str:
+    if result['bench'] == 'scan':
+        return (f'scan interval={result["interval"]} latency={result["latency"]} loss={result["loss"]} '
+                f'workers={result["workers"]} readers_per_device={result.get("readers_per_device")}')
+    if result['bench'] == 'md4':
+        return f'md4 {result["impl"]} lanes={result["lanes"]}'
+    if result['bench'] == 'ed2k':
+        return f'ed2k block_size={result["block_size"]}'
+    return (f'hash_files {result["strategy"]} workers={result["workers"]} '
+            f'readers_per_device={result.get("readers_per_device")} chunk_threads={result["chunk_threads"]} '
+            f'block_size={result["block_size"]}')
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__), capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark TsuboDB hashing')
+    parser.add_argument('--output', help='Write results as JSON to this file.')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare against.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    hash_parser = subparsers.add_parser('hash', help='Throughput of Ed2k and hash_files on synthetic files.')
+    hash_parser.add_argument('--dir', help='Directory for the synthetic files (put it on the disk to measure).')
+    hash_parser.add_argument('--sizes', help='Sizes in bytes of the synthetic files.', type=int, nargs='+', default=DEFAULT_SIZES)
+    hash_parser.add_argument('--block-sizes', help='Read sizes to try.', type=int, nargs='+', default=[65536, 131072, 1 << 20])
+    hash_parser.add_argument('--workers', help='Numbers of hashing threads to try.', type=int, nargs='+', default=[1, 2, 4])
+    hash_parser.add_argument('--chunk-threads', help='Threads per file for the chunked read strategy.', type=int, default=4)
+    hash_parser.add_argument('--readers-per-device', help='Files read at once from the one device the synthetic files are on '
+                             f'(0 for no limit, so every worker reads; tsubodb defaults to {tsubodb.hash.DEFAULT_READERS_PER_DEVICE}).',
+                             type=int, default=0)
+    hash_parser.add_argument('--skip-vectors', help="Don't check against the known ed2k vectors.", action='store_true')
+
+    md4_parser = subparsers.add_parser('md4', help='Throughput of the numpy md4 against OpenSSL.')
+    md4_parser.add_argument('--lanes', help='Number of messages hashed together by the numpy md4.', type=int, nargs='+',
+                            default=[1, 16, 64, 256, 1024])
+    md4_parser.add_argument('--lane-size', help='Size in bytes of each message.', type=int, default=65536)
+
+    scan_parser = subparsers.add_parser('scan', help='Full scan and import of a synthetic library, against a local stand-in AniDB.')
+    scan_parser.add_argument('--dir', help='Directory for the synthetic library.')
+    scan_parser.add_argument('--files', help='Number of files in the library.', type=int, default=200)
+    scan_parser.add_argument('--dirs', help='Number of directories to spread them over.', type=int, default=20)
+    scan_parser.add_argument('--file-size', help='Largest file size in bytes.', type=int, default=1 << 20)
+    scan_parser.add_argument('--interval', help='Seconds between packets, the server bans anything faster '
+                             '(AniDB needs 2, 0 measures everything else).', type=float, default=0.0)
+    scan_parser.add_argument('--latency', help='Seconds before each reply from the server.', type=float, default=0.0)
+    scan_parser.add_argument('--loss', help='Fraction of packets the server drops.', type=float, default=0.0)
+    scan_parser.add_argument('--unknown-rate', help='Fraction of files the server doesn\'t know.', type=float, default=0.0)
+    scan_parser.add_argument('--workers', help='Number of hashing threads.', type=int, default=tsubodb.hash.DEFAULT_HASH_THREADS)
+    scan_parser.add_argument('--readers-per-device', help='Files read at once from each device (0 for no limit).', type=int,
+                             default=tsubodb.hash.DEFAULT_READERS_PER_DEVICE)
+
+    args = parser.parse_args()
+
+    results: List[Dict[str, Any]] = []
+    failures: List[str] = []
+    if args.command == 'md4':
+        results = bench_md4(args.lanes, args.lane_size)
+    elif args.command == 'hash':
+        strategies = read_strategies(args.chunk_threads)
+        with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+            if not args.skip_vectors:
+                failures = check_vectors(directory, strategies)
+                for failure in failures:
+                    print('FAIL', failure)
+            files = make_files(directory, args.sizes)
+            results = bench_ed2k(args.block_sizes, max(args.sizes))
+            results += bench_hashing(files, args.block_sizes, args.workers, strategies, args.readers_per_device)
+    elif args.command == 'scan':
+        with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+            library = os.path.join(directory, 'anime')
+            make_library(library, args.files, args.dirs, args.file_size)
+            with DevServer(latency=args.latency, loss=args.loss, ban_interval=args.interval,
+                           unknown_rate=args.unknown_rate) as server:
+                results = [bench_scan(library, os.path.join(directory, 'bench.db'), server, args.interval, args.workers,
+                                      args.readers_per_device)]
+
+    for result in results:
+        if result['bench'] == 'scan':
+            for run in ('first', 'rescan'):
+                r = result[run]
+                print(f'{_describe(result)} {run}: {r["files"]} files ({r["unknown"]} unknown) in {r["seconds"]:.2f}s, '
+                      f'{r["files_per_minute"]:.0f} files/min, {r["packets_per_file"]:.2f} packets/file')
+            continue
+        line = f'{_describe(result)}: {result["mb_per_s"]:.2f} MB/s'
+        if 'cpu_seconds' in result:
+            line += f', {result["cpu_seconds"]:.2f}s CPU in {result["seconds"]:.2f}s'
+        if result.get('correct') is False:
+            line += ' WRONG HASH'
+        print(line)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+    if args.output:
+        meta = {'revision': _git_revision(), 'time': time.time(), 'python': sys.version, 'platform': platform.platform(),
+                'cpu_count': os.cpu_count(), 'hashlib_md4': tsubodb.hash.HASHLIB_MD4, 'vector_failures': failures}
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+    if failures or any(r.get('correct') is False for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
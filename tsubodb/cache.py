@@ -0,0 +1,131 @@
+"""
+On-disk cache of AniDB replies, so repeated requests for the same data don't cost packets
+
+Kept in its own SQLite file, as the AniDB client can be used from a different thread than the one
+holding LocalDB's connection (and its write transaction).
+"""
+import json
+import os
+import sqlite3
+import time
+
+from typing import Any, Dict, List, Optional, Tuple
+
+
+ApiResponse = Tuple[int, str, List[List[str]]]  # Same as tsubodb.api's, which imports this module
+
+DAY = 24 * 60 * 60
+
+# Seconds each (command, reply code) is kept for, only these are cached
+DEFAULT_TTLS: Dict[Tuple[str, int], float] = {
+    ('FILE', 220): 30 * DAY,  # File info barely ever changes
+    ('MYLIST', 221): DAY,  # Can be changed from elsewhere, e.g. the website
+}
+
+# Commands that change data on AniDB, and so make cached replies about the same things stale
+MUTATING_COMMANDS = ('MYLISTADD', 'VOTE')
+
+DEFAULT_MAX_ENTRIES = 50000
+
+# Args that differ between otherwise identical requests
+_IGNORED_ARGS = ('s', 'tag')
+
+
+def cache_key(cmd: str, args: Dict[str, Any]) -> str:
+    '''Command and args in a fixed order, without the session or tag'''
+    params = '&'.join(f'{k}={v}' for k, v in sorted(args.items()) if k not in _IGNORED_ARGS)
+    return f'{cmd} {params}'
+
+
+def _related_ids(cmd: str, args: Dict[str, Any], data: List[List[str]]) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    '''(fid, lid, aid) that a reply is about, where known, so it can be dropped when they change'''
+    row = data[0] if data else []
+    if cmd == 'MYLIST' and len(row) >= 4:
+        return row[1], row[0], row[3]
+    if cmd == 'FILE' and row:
+        # aid is the first field after fid when it's requested, as it's the highest fmask bit
+        aid = row[1] if int(args.get('fmask', '0'), 16) & (1 << 38) and len(row) > 1 else None
+        return row[0], None, aid
+    return None, None, None
+
+
+class ResponseCache:
+    def __init__(self, path: str, ttls: Optional[Dict[Tuple[str, int], float]]=None,
+            max_entries: int=DEFAULT_MAX_ENTRIES):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Only used under the AniDB client's lock, but that can be from any thread
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.conn.execute('''
+CREATE TABLE IF NOT EXISTS "Responses" (
+        "key" TEXT UNIQUE,
+        "cmd" TEXT,
+        "response" TEXT,
+        "expires" REAL,
+        "used" REAL,
+        "fid" TEXT,
+        "lid" TEXT,
+        "aid" TEXT,
+        PRIMARY KEY("key")
+);
+''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS "ResponsesUsed" ON "Responses" ("used")')
+
+    def get(self, cmd: str, args: Dict[str, Any]) -> Optional[ApiResponse]:
+        '''
+        The cached reply to a request, or None if it has to be sent
+        Mutating commands are never cached, looking one up drops the replies it will make stale
+        '''
+        if cmd in MUTATING_COMMANDS:
+            self.invalidate(cmd, args)
+            return None
+        if not any(cached_cmd == cmd for cached_cmd, _ in self.ttls):
+            return None
+        key = cache_key(cmd, args)
+        now = time.time()
+        row = self.conn.execute('SELECT response FROM Responses WHERE key = ? AND expires > ?', [key, now]).fetchone()
+        if not row:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute('UPDATE Responses SET used = ? WHERE key = ?', [now, key])
+        code, text, data = json.loads(row[0])
+        return code, text, data
+
+    def put(self, cmd: str, args: Dict[str, Any], response: ApiResponse) -> None:
+        ttl = self.ttls.get((cmd, response[0]))
+        if not ttl:
+            return
+        now = time.time()
+        fid, lid, aid = _related_ids(cmd, args, response[2])
+        self.conn.execute('INSERT OR REPLACE INTO Responses VALUES(?, ?, ?, ?, ?, ?, ?, ?)',
+                          [cache_key(cmd, args), cmd, json.dumps(response), now + ttl, now, fid, lid, aid])
+        self._evict()
+
+    def invalidate(self, cmd: str, args: Dict[str, Any]) -> None:
+        '''Drop replies made stale by the mutating command cmd'''
+        if cmd == 'MYLISTADD':
+            if 'lid' in args:
+                self.conn.execute('DELETE FROM Responses WHERE lid = ?', [str(args['lid'])])
+            if 'fid' in args:
+                self.conn.execute('DELETE FROM Responses WHERE fid = ?', [str(args['fid'])])
+        elif cmd == 'VOTE':
+            self.conn.execute('DELETE FROM Responses WHERE aid = ?', [str(args.get('id'))])
+
+    def _evict(self) -> None:
+        '''Drop expired replies, then the least recently used ones over max_entries'''
+        self.conn.execute('DELETE FROM Responses WHERE expires <= ?', [time.time()])
+        self.conn.execute('''
+DELETE FROM Responses WHERE key IN (
+        SELECT key FROM Responses ORDER BY used DESC LIMIT -1 OFFSET ?
+)
+''', [self.max_entries])
+
+    def clear(self) -> None:
+        self.conn.execute('DELETE FROM Responses')
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the AniDB UDP API, for testing and benchmarking without the real server
+
+Speaks the commands the client uses (AUTH, LOGOUT, PING, FILE, MYLIST, MYLISTADD, VOTE, WISHLISTDEL),
+inventing consistent info for any file asked about. Latency, packet loss, error replies and flood
+bans can be simulated.
+
+Run with: python -m tsubodb.devserver --port 9000 --latency 0.1
+"""
+import argparse
+import hashlib
+import random
+import socket
+import threading
+import time
+import zlib
+
+from typing import Dict, List, Optional, Tuple
+
+from tsubodb.api import fmask, amask, masks
+from tsubodb.ratelimit import SHORT_TERM_INTERVAL
+
+
+# Like AniDB, clients sending faster than its short term limit are banned
+DEFAULT_BAN_INTERVAL = SHORT_TERM_INTERVAL
+
+# Allowance for scheduling jitter, so a client pacing packets exactly ban_interval apart isn't banned
+BAN_SLACK = 0.05
+
+# Codes of all the info FILE can return, highest mask bit (first returned) first
+_INFO_CODES = sorted((code for code in fmask + amask if code), key=lambda code: masks[code], reverse=True)
+
+
+class FakeAniDB:
+    """Server state, and the reply to each command"""
+    def __init__(self, unknown_rate: float=0.0, seed: int=0):
+        self.unknown_rate = unknown_rate
+        self.seed = seed
+        self.sessions: Dict[str, Tuple[str, int]] = dict()
+        self.mylist: Dict[int, List[int]] = dict()  # lid -> lid, fid, eid, aid, gid, date, state, viewdate
+        self.next_lid = 1
+
+    def _number(self, *key: object, modulo: int=10**6) -> int:
+        '''Deterministic pseudo-random number for key'''
+        digest = hashlib.sha1(repr((self.seed,) + key).encode()).digest()
+        return int.from_bytes(digest[:8], 'big') % modulo + 1
+
+    def _file(self, args: Dict[str, str]) -> Optional[Dict[str, str]]:
+        if 'fid' in args:
+            fid = int(args['fid'])
+        else:
+            if self._number('unknown', args.get('size'), args.get('ed2k')) <= self.unknown_rate * 10**6:
+                return None
+            fid = self._number('fid', args.get('size'), args.get('ed2k'))
+        aid = self._number('aid', fid, modulo=2000)
+        epno = self._number('epno', fid, modulo=24)
+        info = {code: '' for code in _INFO_CODES}
+        info.update({'aid': str(aid), 'eid': str(self._number('eid', fid)), 'gid': str(self._number('gid', fid, modulo=500)),
+                     'size': args.get('size', ''), 'ed2k': args.get('ed2k', ''),
+                     'english': f'Anime {aid}', 'romaji': f'Anime {aid}', 'kanji': f'アニメ {aid}',
+                     'epno': f'{epno:02}', 'epname': f'Episode {epno}', 'epromaji': f'Episode {epno}',
+                     'epkanji': f'第{epno}話', 'eptotal': '24', 'eplast': '24'})
+        info['fid'] = str(fid)
+        return info
+
+    def _mylist_line(self, entry: List[int]) -> str:
+        return '|'.join(str(value) for value in entry) + '|||'
+
+    def reply(self, cmd: str, args: Dict[str, str], address: Tuple[str, int]) -> str:
+        if cmd == 'PING':
+            return f'300 PONG\n{address[1]}' if args.get('nat') else '300 PONG'
+        if cmd == 'AUTH':
+            session = f'{self._number("session", time.time(), address):x}'
+            self.sessions[session] = address
+            return f'200 {session} {address[0]}:{address[1]} LOGIN ACCEPTED'
+        if self.sessions.get(args.get('s', '')) != address:
+            return '506 INVALID SESSION'
+        if cmd == 'LOGOUT':
+            del self.sessions[args['s']]
+            return '203 LOGGED OUT'
+
+        if cmd == 'FILE':
+            info = self._file(args)
+            if not info:
+                return '320 NO SUCH FILE'
+            code = (int(args.get('fmask', '0'), 16) << 32) | int(args.get('amask', '0'), 16)
+            fields = [info['fid']] + [info[name] for name in _INFO_CODES if code & masks[name]]
+            return '220 FILE\n' + '|'.join(fields)
+
+        if cmd == 'MYLIST':
+            for entry in self.mylist.values():
+                if ('lid' in args and entry[0] == int(args['lid'])) or ('fid' in args and entry[1] == int(args['fid'])):
+                    return '221 MYLIST\n' + self._mylist_line(entry)
+            return '321 NO SUCH ENTRY'
+
+        if cmd == 'MYLISTADD':
+            viewdate = int(time.time()) if args.get('viewed') == '1' else 0
+            if 'lid' in args:
+                edited = self.mylist.get(int(args['lid']))
+                if edited is None:
+                    return '411 NO SUCH MYLIST ENTRY'
+                if 'viewed' in args:
+                    edited[7] = viewdate
+                return '311 MYLIST ENTRY EDITED\n1'
+            fid = int(args['fid'])
+            for entry in self.mylist.values():
+                if entry[1] == fid:
+                    return '310 FILE ALREADY IN MYLIST\n' + self._mylist_line(entry)
+            info = self._file(args)
+            if not info:
+                return '320 NO SUCH FILE'
+            lid = self.next_lid
+            self.next_lid += 1
+            self.mylist[lid] = [lid, fid, int(info['eid']), int(info['aid']), int(info['gid']), int(time.time()),
+                                int(args.get('storage', 0)), viewdate]
+            return f'210 MYLIST ENTRY ADDED\n{lid}'
+
+        if cmd == 'VOTE':
+            return f'260 VOTED\nAnime {args.get("id")}|{args.get("value")}|{args.get("type")}|{args.get("id")}'
+        if cmd == 'WISHLISTDEL':
+            return '227 WISHLIST ENTRY DELETED'
+        return '598 UNKNOWN COMMAND'
+
+
+class DevServer:
+    """
+    UDP server in a background thread, answering like AniDB
+    latency: seconds before each reply
+    loss: fraction of requests (and replies) silently dropped
+    error_rate: fraction of requests answered with a server error instead
+    ban_interval: clients sending faster than one packet per this many seconds are banned (0 to allow any rate)
+    """
+    def __init__(self, host: str='127.0.0.1', port: int=0, latency: float=0.0, loss: float=0.0, error_rate: float=0.0,
+            ban_interval: float=DEFAULT_BAN_INTERVAL, unknown_rate: float=0.0, seed: int=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.address: Tuple[str, int] = self.sock.getsockname()
+        self.latency = latency
+        self.loss = loss
+        self.error_rate = error_rate
+        self.ban_interval = ban_interval
+        self.state = FakeAniDB(unknown_rate, seed)
+        self.random = random.Random(seed)
+        self.last_packet: Dict[Tuple[str, int], float] = dict()
+        self.banned: Dict[Tuple[str, int], str] = dict()
+        self.compressed: Dict[Tuple[str, int], bool] = dict()
+        self.packets: Dict[str, int] = dict()  # Requests received per command
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.running = False
+
+    @property
+    def total_packets(self) -> int:
+        return sum(self.packets.values())
+
+    def start(self) -> 'DevServer':
+        self.running = True
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.running = False
+        # Wake up the recvfrom
+        self.sock.sendto(b'', self.address)
+        self.thread.join()
+        self.sock.close()
+
+    def __enter__(self) -> 'DevServer':
+        return self.start()
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.stop()
+
+    def _run(self) -> None:
+        while True:
+            data, address = self.sock.recvfrom(65507)
+            if not self.running:
+                return
+            if data:
+                self._handle(data.decode(errors='replace'), address)
+
+    def _handle(self, data: str, address: Tuple[str, int]) -> None:
+        cmd, _, params = data.strip().partition(' ')
+        args = dict(param.split('=', 1) for param in params.split('&') if '=' in param)
+        with self.lock:
+            self.packets[cmd] = self.packets.get(cmd, 0) + 1
+            now = time.monotonic()
+            last = self.last_packet.get(address)
+            self.last_packet[address] = now
+            if self.ban_interval and last is not None and now - last < self.ban_interval - BAN_SLACK:
+                self.banned[address] = f'Sent {now - last:.2f}s after the previous packet'
+            if self.random.random() < self.loss:
+                return
+            if address in self.banned:
+                # Like AniDB, bans are reported without the tag
+                self._send(f'555 BANNED\n{self.banned[address]}\n', address, False)
+                return
+            if self.random.random() < self.error_rate:
+                reply = self.random.choice(('600 INTERNAL SERVER ERROR', '602 SERVER BUSY'))
+            else:
+                reply = self.state.reply(cmd, args, address)
+            if cmd == 'AUTH':
+                self.compressed[address] = args.get('comp') == '1'
+        tag = args.get('tag')
+        self._send(f'{tag} {reply}\n' if tag else f'{reply}\n', address, self.compressed.get(address, False))
+
+    def _send(self, reply: str, address: Tuple[str, int], compress: bool) -> None:
+        data = reply.encode()
+        if compress:
+            data = b'\x00\x00' + zlib.compress(data)
+        if self.latency:
+            threading.Timer(self.latency, self.sock.sendto, (data, address)).start()
+        else:
+            self.sock.sendto(data, address)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Local stand-in for the AniDB UDP API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency', help='Seconds before each reply.', type=float, default=0.0)
+    parser.add_argument('--loss', help='Fraction of requests dropped.', type=float, default=0.0)
+    parser.add_argument('--error-rate', help='Fraction of requests answered with a server error.', type=float, default=0.0)
+    parser.add_argument('--ban-interval', help='Ban clients sending packets closer together than this many seconds.',
+                        type=float, default=DEFAULT_BAN_INTERVAL)
+    parser.add_argument('--unknown-rate', help='Fraction of files (by size/ed2k) that are unknown.', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = DevServer(args.host, args.port, args.latency, args.loss, args.error_rate, args.ban_interval, args.unknown_rate)
+    print(f'Listening on {server.address[0]}:{server.address[1]} (ctrl-c to stop)')
+    server.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+    print(server.packets)
+
+
+if __name__ == '__main__':
+    main()
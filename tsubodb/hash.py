@@ -1,5 +1,10 @@
+import collections
+import concurrent.futures
+import io
+import queue
 import threading
 import time
+import typing
 import os
 
 # OpenSSL (which hashlib uses) started disabling the use of md4 by default, so try to enable that here
@@ -13,86 +18,394 @@ except:
 
 import hashlib
 
+from tsubodb import md4
+
 try:
     hashlib.new('md4')
+    HASHLIB_MD4 = True
 except ValueError as e:
-    print(e)
-    print('\x1b[31m' + "ERROR: MD4 hash not supported on this system - cannot hash files. See https://github.com/ecederstrand/exchangelib/issues/608 for a potential solution." + '\x1b[0m')
+    # Fall back to the (much slower) numpy implementation
+    HASHLIB_MD4 = False
+    if not md4.available():
+        print(e)
+        print('\x1b[31m' + "ERROR: MD4 hash not supported on this system, and numpy is not installed - cannot hash files. See https://github.com/ecederstrand/exchangelib/issues/608 for a potential solution." + '\x1b[0m')
 
 from tsubodb.types import *
-from typing import Any, Iterable, List
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+
+DEFAULT_HASH_THREADS = os.cpu_count() or 1
+
+# Files read at once from each device, one keeps a spinning disk reading sequentially
+DEFAULT_READERS_PER_DEVICE = 1
+
+# ed2k hashes the file in chunks of this size, then hashes the list of chunk digests
+ED2K_CHUNK_SIZE = 9728000
+
+# Size of each read from disk while hashing
+DEFAULT_BLOCK_SIZE = 131072
+
+# Minimum seconds between saving the progress through hashing a file
+CHECKPOINT_INTERVAL = 5.0
 
 
 class Ed2k:
     def __init__(self) -> None:
-        self.md4_partial = hashlib.new('md4')
-        self.md4_final = hashlib.new('md4')
+        self.chunk_digests: List[bytes] = []
         self.size_total = 0
+        if HASHLIB_MD4:
+            self.md4_partial = hashlib.new('md4')
+        else:
+            # Without hashlib's md4, buffer whole chunks and hash a batch of them together
+            self.pending_chunks: List[bytes] = []
+            self.partial = bytearray()
 
-    def update(self, data: bytes) -> None:
+    def update(self, data: Union[bytes, bytearray, memoryview]) -> None:
+        # Slicing a memoryview doesn't copy the data
+        data = memoryview(data)
         pos = 0
         while pos < len(data):
-            if (not (self.size_total % 9728000)) and self.size_total:
-                self.md4_final.update(self.md4_partial.digest())
-                self.md4_partial = hashlib.new('md4')
-            size = min(len(data) - pos, 9728000 - (self.size_total % 9728000))
-            self.md4_partial.update(data[pos:pos + size])
+            size = min(len(data) - pos, ED2K_CHUNK_SIZE - (self.size_total % ED2K_CHUNK_SIZE))
+            if HASHLIB_MD4:
+                self.md4_partial.update(data[pos:pos + size])
+            else:
+                self.partial += data[pos:pos + size]
             pos += size
             self.size_total += size
+            if not self.size_total % ED2K_CHUNK_SIZE:
+                self._end_chunk()
+
+    def _end_chunk(self) -> None:
+        if HASHLIB_MD4:
+            self.chunk_digests.append(self.md4_partial.digest())
+            self.md4_partial = hashlib.new('md4')
+        else:
+            self.pending_chunks.append(bytes(self.partial))
+            self.partial = bytearray()
+            if len(self.pending_chunks) >= md4.BATCH_SIZE:
+                self._hash_pending()
+
+    def _hash_pending(self) -> None:
+        self.chunk_digests += md4.md4_many(self.pending_chunks)
+        self.pending_chunks = []
+
+    def checkpoint(self) -> List[bytes]:
+        """Digests of the completed chunks - the state up to the last chunk boundary"""
+        if not HASHLIB_MD4:
+            self._hash_pending()
+        return list(self.chunk_digests)
+
+    @classmethod
+    def resume(cls, chunk_digests: List[bytes]) -> 'Ed2k':
+        """Continue from a checkpoint, the next update should start at the following chunk"""
+        h = cls()
+        h.chunk_digests = list(chunk_digests)
+        h.size_total = len(chunk_digests) * ED2K_CHUNK_SIZE
+        return h
 
     def hexdigest(self) -> str:
-        if self.size_total > 9728000:
-            self.md4_final.update(self.md4_partial.digest())
-            return self.md4_final.hexdigest()
-        return self.md4_partial.hexdigest()
+        if self.size_total and not self.size_total % ED2K_CHUNK_SIZE:
+            # Ended exactly on a chunk boundary, so there's no partial chunk
+            return self.combine(self.checkpoint())
+        if HASHLIB_MD4:
+            return self.combine(self.chunk_digests + [self.md4_partial.digest()])
+        return self.combine(self.checkpoint() + md4.md4_many([self.partial]))
+
+    @staticmethod
+    def combine(chunk_digests: List[bytes]) -> str:
+        """
+        Combine the in-order digests of every chunk into the ed2k hash
+        A file of a single chunk (or less) is just the md4 of that chunk
+        """
+        if len(chunk_digests) == 1:
+            return chunk_digests[0].hex()
+        if not HASHLIB_MD4:
+            return md4.md4_many([b''.join(chunk_digests)])[0].hex()
+        md4_final = hashlib.new('md4')
+        for digest in chunk_digests:
+            md4_final.update(digest)
+        return md4_final.hexdigest()
+
+
+def read_blocks(f: io.RawIOBase, block_size: int=DEFAULT_BLOCK_SIZE, limit: Optional[int]=None) -> Iterator[memoryview]:
+    """
+    Read f (up to limit bytes) into a single reused buffer, yielding a view of the filled part
+    Each view is only valid until the next one is requested
+    """
+    view = memoryview(bytearray(block_size))
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = block_size if remaining is None else min(block_size, remaining)
+        read = f.readinto(view[:size])
+        if not read:
+            return
+        yield view[:read]
+        if remaining is not None:
+            remaining -= read
+
+
+def hash_chunk(filename: str, index: int, block_size: int=DEFAULT_BLOCK_SIZE) -> bytes:
+    """md4 digest of a single ed2k chunk, read from its own file handle"""
+    chunk_md4 = hashlib.new('md4')
+    with open(filename, 'rb', buffering=0) as f:
+        f.seek(index * ED2K_CHUNK_SIZE)
+        for data in read_blocks(f, block_size, ED2K_CHUNK_SIZE):
+            chunk_md4.update(data)
+    return chunk_md4.digest()
+
+
+def quick_hash(filename: str, block_size: int=DEFAULT_BLOCK_SIZE) -> HashStr:
+    """
+    Cheap fingerprint of a file: the md4 of its first ed2k chunk (so the same as Hash(filename).quickhash)
+    Together with the size this is enough to recognise a file that was moved or restored, without reading all of it
+    """
+    if HASHLIB_MD4:
+        return HashStr(hash_chunk(filename, 0, block_size).hex())
+    size = os.path.getsize(filename)
+    with open(filename, 'rb', buffering=0) as f:
+        return HashStr(md4.hash_file_chunks(f, [0], [min(size, ED2K_CHUNK_SIZE)], block_size)[0].hex())
 
 
 class Hash:
-    def __init__(self, filename: str):
-        h = Ed2k()
-
-        f = open(filename, 'rb')
-        data = f.read(131072)
-        while data:
-            h.update(data)
-            data = f.read(131072)
+    def __init__(self, filename: str, chunk_threads: int=1, block_size: int=DEFAULT_BLOCK_SIZE,
+            resume: Optional[List[bytes]]=None, on_checkpoint: Optional[Callable[[List[bytes]], None]]=None):
+        """
+        resume: chunk digests from an earlier checkpoint of this file, hashing continues after them
+        on_checkpoint: called with the digests of all completed chunks as hashing progresses
+        """
+        size = os.path.getsize(filename)
+        resume = resume or []
+        if not HASHLIB_MD4:
+            self._set_digests(self._lockstep_chunk_digests(filename, size, block_size, resume, on_checkpoint))
+            return
+
+        if chunk_threads > 1 and size > ED2K_CHUNK_SIZE:
+            self._set_digests(self._parallel_chunk_digests(filename, size, chunk_threads, block_size, resume, on_checkpoint))
+            return
+
+        h = Ed2k.resume(resume)
+        # Unbuffered, so readinto goes straight from the OS into our buffer
+        with open(filename, 'rb', buffering=0) as f:
+            f.seek(h.size_total)
+            completed = len(h.chunk_digests)
+            for data in read_blocks(f, block_size):
+                h.update(data)
+                if on_checkpoint and len(h.chunk_digests) != completed:
+                    completed = len(h.chunk_digests)
+                    on_checkpoint(h.checkpoint())
         self.ed2k = h.hexdigest()
+        # A file of at most one chunk is its own first chunk
+        self.quickhash = h.chunk_digests[0].hex() if h.chunk_digests else self.ed2k
+
+    def _set_digests(self, chunk_digests: List[bytes]) -> None:
+        self.ed2k = Ed2k.combine(chunk_digests)
+        self.quickhash = chunk_digests[0].hex()
+
+    @staticmethod
+    def _parallel_chunk_digests(filename: str, size: int, chunk_threads: int, block_size: int, resume: List[bytes],
+            on_checkpoint: Optional[Callable[[List[bytes]], None]]) -> List[bytes]:
+        # Chunks are independent, so hash them concurrently and combine in order
+        num_chunks = -(-size // ED2K_CHUNK_SIZE)
+        digests: List[Optional[bytes]] = list(resume) + [None] * (num_chunks - len(resume))
+        completed = len(resume)
+        with concurrent.futures.ThreadPoolExecutor(min(chunk_threads, num_chunks)) as executor:
+            futures = {executor.submit(hash_chunk, filename, i, block_size): i for i in range(len(resume), num_chunks)}
+            for future in concurrent.futures.as_completed(futures):
+                digests[futures[future]] = future.result()
+                # Only the run of completed chunks from the start of the file can be checkpointed
+                start = completed
+                while completed < num_chunks and digests[completed] is not None:
+                    completed += 1
+                if on_checkpoint and completed != start:
+                    on_checkpoint(typing.cast(List[bytes], digests[:completed]))
+        return typing.cast(List[bytes], digests)
+
+    @staticmethod
+    def _lockstep_chunk_digests(filename: str, size: int, block_size: int, resume: List[bytes],
+            on_checkpoint: Optional[Callable[[List[bytes]], None]]) -> List[bytes]:
+        # Hash all chunks of the file together with the numpy md4, reading block_size from each in turn
+        offsets = list(range(0, size, ED2K_CHUNK_SIZE)) or [0]
+        digests = list(resume)
+        lanes = md4.max_lanes(block_size)
+        with open(filename, 'rb', buffering=0) as f:
+            for first in range(len(resume), len(offsets), lanes):
+                group = offsets[first:first + lanes]
+                lengths = [min(ED2K_CHUNK_SIZE, size - offset) for offset in group]
+                digests += md4.hash_file_chunks(f, group, lengths, block_size)
+                if on_checkpoint:
+                    on_checkpoint(list(digests))
+        return digests
+
+
+class HashCheckpoint:
+    """Progress through hashing a file, passed from the hashing threads to hash_files' checkpoint callback"""
+    def __init__(self, name: str, size: int, mtime_ns: int, chunk_digests: List[bytes]):
+        self.name = name
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.chunk_digests = chunk_digests
+
+    @property
+    def offset(self) -> int:
+        return len(self.chunk_digests) * ED2K_CHUNK_SIZE
 
 
 class HashedFile:
-    def __init__(self, name: str):
+    def __init__(self, name: str, chunk_threads: int=1, block_size: int=DEFAULT_BLOCK_SIZE,
+            resume: Optional[HashCheckpoint]=None, on_checkpoint: Optional[Callable[[HashCheckpoint], None]]=None):
+        """
+        resume: an earlier checkpoint of this file, only used if the file's size and mtime still match it
+        """
         self.name = name
-        self.size = os.path.getsize(name)
-        self.mtime = os.path.getmtime(name)
-        h = Hash(name)
+        st = os.stat(name)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        # Identifies the file even if it gets moved/renamed (within the same filesystem)
+        self.dev = st.st_dev
+        self.inode = st.st_ino
+        self.mtime_ns = st.st_mtime_ns
+        checkpoint = None
+        if on_checkpoint:
+            callback = on_checkpoint
+            checkpoint = lambda digests: callback(HashCheckpoint(name, self.size, self.mtime_ns, digests))
+        digests = None
+        if resume and resume.size == self.size and resume.mtime_ns == self.mtime_ns and resume.offset <= self.size:
+            digests = resume.chunk_digests
+        h = Hash(name, chunk_threads, block_size, digests, checkpoint)
         self.ed2k = HashStr(h.ed2k)
+        self.quickhash = HashStr(h.quickhash)
+
+
+class HashError:
+    """A file that couldn't be hashed, passed from the hashing threads to hash_files' on_error callback"""
+    def __init__(self, name: str, error: OSError):
+        self.name = name
+        self.error = error
+
+
+HashResult = Union[HashedFile, HashCheckpoint, HashError, None]
+
+
+class HashScheduler:
+    """
+    Hands out files to the hashing threads, grouped by the device they're on
+    Each device gets at most per_device concurrent readers (0 for no limit), so a spinning disk isn't
+    thrashed by several sequential streams while other devices sit idle
+    """
+    def __init__(self, files: List[str], per_device: int=DEFAULT_READERS_PER_DEVICE, small_first: bool=False):
+        self.per_device = per_device
+        self.small_first = small_first
+        self.ready = threading.Condition()
+        # Per device: (size, original position, file name)
+        self.queues: Dict[int, typing.Deque[Tuple[int, int, str]]] = dict()
+        self.active: Dict[int, int] = dict()
+        pending: Dict[int, List[Tuple[int, int, str]]] = dict()
+        for i, f in enumerate(files):
+            try:
+                st = os.stat(f)
+                dev, size = st.st_dev, st.st_size
+            except OSError:
+                # Will be reported when it fails to hash
+                dev, size = -1, 0
+            pending.setdefault(dev, []).append((size, i, f))
+        for dev, items in pending.items():
+            if small_first:
+                items.sort()
+            self.queues[dev] = collections.deque(items)
+            self.active[dev] = 0
+
+    def next(self) -> Optional[Tuple[int, str]]:
+        """Wait for a file that can be read now, returns (device, file name) or None when all are taken"""
+        with self.ready:
+            while True:
+                devices = [dev for dev, q in self.queues.items()
+                           if q and (not self.per_device or self.active[dev] < self.per_device)]
+                if devices:
+                    if self.small_first:
+                        dev = min(devices, key=lambda d: self.queues[d][0][:2])
+                    else:
+                        # Spread readers across devices, otherwise keep the original order
+                        dev = min(devices, key=lambda d: (self.active[d], self.queues[d][0][1]))
+                    self.active[dev] += 1
+                    return dev, self.queues[dev].popleft()[2]
+                if not any(self.queues.values()):
+                    return None
+                self.ready.wait()
+
+    def done(self, dev: int) -> None:
+        with self.ready:
+            self.active[dev] -= 1
+            self.ready.notify_all()
 
 
 class Hashthread(threading.Thread):
-    def __init__(self, filelist: List[str], hashlist: List[HashedFile], *args: Any, **kwargs: Any):
-        self.filelist = filelist
+    def __init__(self, scheduler: HashScheduler, hashlist: 'queue.Queue[HashResult]', chunk_threads: int,
+            block_size: int, resume: Dict[str, HashCheckpoint], checkpoints: bool, *args: Any, **kwargs: Any):
+        self.scheduler = scheduler
         self.hashlist = hashlist
+        self.chunk_threads = chunk_threads
+        self.block_size = block_size
+        self.resume = resume
+        self.checkpoints = checkpoints
+        self.last_checkpoint = 0.0
         threading.Thread.__init__(self, *args, daemon=True, **kwargs)
 
+    def checkpoint(self, checkpoint: HashCheckpoint) -> None:
+        # Limit how often they're sent, each one is a DB write
+        now = time.monotonic()
+        if now - self.last_checkpoint >= CHECKPOINT_INTERVAL:
+            self.last_checkpoint = now
+            self.hashlist.put(checkpoint)
+
     def run(self) -> None:
+        # hashlib and file reads release the GIL, so several of these can hash in parallel
         try:
             while 1:
-                f = self.filelist.pop(0)
-                self.hashlist.append(HashedFile(f))
-        except IndexError:
-            return
+                item = self.scheduler.next()
+                if item is None:
+                    break
+                dev, f = item
+                try:
+                    self.hashlist.put(HashedFile(f, self.chunk_threads, self.block_size, self.resume.get(f),
+                                                 self.checkpoint if self.checkpoints else None))
+                except OSError as e:
+                    self.hashlist.put(HashError(f, e))
+                finally:
+                    self.scheduler.done(dev)
+        finally:
+            # Sentinel so the consumer knows this worker is finished
+            self.hashlist.put(None)
 
 
-def hash_files(files: List[str], num_threads: int=1) -> Iterable[HashedFile]:
-    hashlist: List[HashedFile] = []
-    threads = []
+def hash_files(files: List[str], num_threads: int=DEFAULT_HASH_THREADS, chunk_threads: int=1,
+        block_size: int=DEFAULT_BLOCK_SIZE, resume: Optional[Dict[str, HashCheckpoint]]=None,
+        checkpoint: Optional[Callable[[HashCheckpoint], None]]=None, per_device: int=DEFAULT_READERS_PER_DEVICE,
+        small_first: bool=False, on_error: Optional[Callable[[str, OSError], None]]=None) -> Iterable[HashedFile]:
+    """
+    Hash files, yielding each as it completes
+    resume: checkpoints to continue from, by file name
+    checkpoint: called (from the thread iterating this) with the progress through large files
+    per_device: maximum files read at once from each device (0 for no limit)
+    small_first: hash the smallest files first, so they're available sooner
+    on_error: called (from the thread iterating this) with each file that couldn't be read, after reporting it
+    """
+    scheduler = HashScheduler(files, per_device, small_first)
+    num_threads = max(1, min(num_threads, len(files)))
+    # Bounded so workers don't run arbitrarily far ahead of a slow consumer
+    hashlist: 'queue.Queue[HashResult]' = queue.Queue(maxsize=num_threads * 2)
     for x in range(num_threads):
-        thread = Hashthread(files, hashlist)
-        thread.start()
-        threads.append(thread)
-    while hashlist or any([thread.is_alive() for thread in threads]):
-        try:
-            yield hashlist.pop(0)
-        except IndexError:
-            time.sleep(0.1)
-    return
+        Hashthread(scheduler, hashlist, chunk_threads, block_size, resume or {}, checkpoint is not None).start()
+    running = num_threads
+    while running:
+        h = hashlist.get()
+        if h is None:
+            running -= 1
+        elif isinstance(h, HashCheckpoint):
+            if checkpoint:
+                checkpoint(h)
+        elif isinstance(h, HashError):
+            print(f'Error hashing {h.name}: {h.error}')
+            if on_error:
+                on_error(h.name, h.error)
+        else:
+            yield h
@@ -1,25 +1,48 @@
 
+import functools
+import queue
 import sqlite3
 import os
-import re
+import threading
 
-from tsubodb.api import AniDB
-from tsubodb.hash import hash_files
+from tsubodb.api import AniDB, ApiDict
+from tsubodb.hash import (DEFAULT_BLOCK_SIZE, DEFAULT_HASH_THREADS, DEFAULT_READERS_PER_DEVICE, HashCheckpoint, HashedFile,
+                          hash_files, quick_hash)
+from tsubodb.mylistexport import read_mylist_export
+from tsubodb.outbox import ADD_WATCHED, WATCHED, OutboxFlusher
+from tsubodb.scan import DirState, scan_tree
 from tsubodb.types import *
-from tsubodb._query import _Query
+from tsubodb._query import _Query, split_epno
 
-from typing import Iterable, Iterator, Optional
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+
+# Info requested from AniDB about each file
+FILE_INFO_CODES = ('eid', 'aid', 'english', 'romaji', 'kanji', 'epname', 'epromaji', 'epkanji', 'epno')
+
+# AniDB requests queued ahead of the network thread by import_files
+NETWORK_QUEUE_SIZE = 4
 
 
 class LocalDB:
     def __init__(self, db_file: str, base_anime_folder: str, anidb: AniDB):
-        self.base_anime_folder = base_anime_folder
+        # Absolute, as the working directory can change after this is created
+        self.base_anime_folder = os.path.abspath(base_anime_folder)
         os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        self.db_file = db_file
         self.conn = sqlite3.connect(db_file)
         self.anidb = anidb
+        self.outbox: Optional[OutboxFlusher] = None
+        self.scanned_directories: List[DirState] = []
+        # Suffixes scanned for, saved with scanned_directories
+        self.scanned_suffixes = ''
+        # Directories with a file that failed to import, their state isn't saved so they're listed again next time
+        self.failed_directories: Set[DbRelPath] = set()
+        # AniDB requests avoided by reusing the reply for another copy of the same file
+        self.saved_requests = 0
+        # Real path, and path relative to base_anime_folder, of each directory - see _path_to_rel
+        self._rel_dirs: Dict[str, Tuple[str, str]] = dict()
 
-        # Add regexp function.
-        self.conn.create_function('regexp', 2, lambda x, y: 1 if re.search(x,y) else 0)
         self.query = _Query(self.conn)
 
         # Make sure DB is up-to-date
@@ -30,56 +53,138 @@ class LocalDB:
         self.conn.commit()
         self.conn.close()
 
+    def commit(self) -> None:
+        self.conn.commit()
+
     def get_file(self, local: LocalFileInfo) -> Optional[FileInfo]:
         file = self.query.get_file_from_local(local)
         if file or local.checked:
             return file
 
-        try:
-            info = self.anidb.get_file(local, ('eid', 'aid', 'english', 'romaji', 'kanji', 'epname', 'epromaji', 'epkanji', 'epno'))
-            local.fid = Fid(int(info['fid']))
-            local.checked = True
-        except AniDBUnknownFile:
-            local.checked = True
+        if self._resolve_duplicate(local):
+            self.saved_requests += 1
+        elif not self._store_file_info(local, self._lookup_file(local)):
+            return None
 
-        self.query.update_local_checked(local)
+        self.get_mylist(local.fid)  # Will add mylist if needed
+
+        return self.query.get_file_from_local(local)
 
-        if not local.fid:
+    # The _lookup_*/_add_* methods only use the network (not the DB), so they can run on another thread
+
+    def _lookup_file(self, local: LocalFileInfo) -> Optional[ApiDict]:
+        '''AniDB's info about a file, or None if it's unknown'''
+        try:
+            return self.anidb.get_file(local, FILE_INFO_CODES)
+        except AniDBUnknownFile:
             return None
 
+    def _store_file_info(self, local: LocalFileInfo, info: Optional[ApiDict]) -> bool:
+        '''Record the result of _lookup_file, returns whether the file is known'''
+        local.checked = True
+        if info:
+            local.fid = Fid(int(info['fid']))
+        self.query.update_local_checked(local)
+        if not info:
+            return False
         self.query.insert_file_from_anidb(info)
+        return True
 
-        self.get_mylist(local.fid)  # Will add mylist if needed
-
-        return self.query.get_file_from_local(local)
+    def _add_mylist(self, fid: Fid, viewed: bool=False) -> MyList:
+        result = self.anidb.add_mylist(fid, storage=1, viewed=viewed)
+        if isinstance(result, MyList):
+            return result
+        lid = Lid(int(result[1][0]))
+        return self.anidb.get_mylist_lid(lid)
 
     def get_mylist(self, fid: Fid, viewed: bool=False) -> Optional[MyList]:
         local_mylist = self.query.get_mylist_from_fid(fid)
         if (local_mylist):
             return local_mylist
-        result = self.anidb.add_mylist(fid, storage=1, viewed=viewed)
-        if isinstance(result, MyList):
-            mylist = result
-        else:
-            lid = Lid(int(result[1][0]))
-            mylist = self.anidb.get_mylist_lid(lid)
+        mylist = self._add_mylist(fid, viewed)
         self.query.insert_mylist(mylist)
         return mylist
 
     def mark_watched(self, fid: Fid) -> None:
-        mylist = self.get_mylist(fid, viewed=True)
-        if mylist and not mylist.watched:
-            self.anidb.mark_watched(mylist.lid)
+        '''Mark watched in the DB now, and queue sending it to AniDB (see start_outbox)'''
+        mylist = self.query.get_mylist_from_fid(fid)
+        if mylist and mylist.watched:
+            return
+        if mylist:
             self.query.mylist_mark_watched(mylist)
+            self.query.insert_outbox(WATCHED, fid, mylist.lid)
+        else:
+            self.query.insert_mylist_placeholder(fid)
+            self.query.insert_outbox(ADD_WATCHED, fid)
+        # The outbox thread can only see it once committed
+        self.conn.commit()
+        if self.outbox:
+            self.outbox.wake.set()
+        else:
+            self.start_outbox()
+
+    def start_outbox(self) -> None:
+        '''Start sending queued MyList changes to AniDB in the background, if there are any'''
+        if not self.outbox and self.query.count_outbox():
+            self.outbox = OutboxFlusher(self.db_file, self.anidb)
+            self.outbox.start()
+
+    def stop_outbox(self, timeout: Optional[float]=None) -> int:
+        '''
+        Give the outbox up to timeout seconds to finish sending, returns how many changes are still queued
+        Logs in first if changes are waiting for a session, which can ask for the password (so call it from the
+        main thread)
+        '''
+        if not self.outbox:
+            return self.query.count_outbox()
+        self.conn.commit()
+        if not self.anidb.session and self.query.count_outbox():
+            try:
+                # Not worth waiting through the retries when offline, the changes stay queued for next time
+                self.anidb.execute('PING', retry=False)
+                self.anidb.auth()
+            except AniDBError as e:
+                print(f'Cannot log in to send MyList changes to AniDB: {e!r}')
+        self.outbox.stop(timeout)
+        self.outbox = None
+        return self.query.count_outbox()
 
     def fetch_mylist(self, fid: Fid) -> None:
         local_mylist = self.query.get_mylist_from_fid(fid)
-        if (local_mylist):
+        # A placeholder's lid isn't known to AniDB
+        if local_mylist and local_mylist.lid > 0:
             mylist = self.anidb.get_mylist_lid(local_mylist.lid)
         else:
             mylist = self.anidb.get_mylist(fid)
         self.query.insert_mylist(mylist)
 
+    def import_mylist_export(self, path: str) -> Tuple[int, int]:
+        '''
+        Load a MyList export file (see tsubodb.mylistexport) into the DB in one go
+        Only the fields the export gives replace those of entries already in the DB, and a watched entry is never
+        marked unwatched, or given a guessed viewdate in place of its real one
+        Returns (entries in the export, entries that were new or changed)
+        '''
+        entries = read_mylist_export(path)
+        existing = self.query.get_all_mylist()
+        fields = ('fid', 'eid', 'aid', 'gid', 'date', 'state')
+        changed = []
+        for mylist, given in entries:
+            old = existing.get(mylist.lid)
+            if old is not None:
+                values = {f: getattr(mylist if f in given else old, f) for f in fields}
+                viewdate = old.viewdate
+                if mylist.viewdate and ('viewdate' in given or ('viewed' in given and not viewdate)):
+                    viewdate = mylist.viewdate
+                if all(int(values[f]) == int(getattr(old, f)) for f in fields) and viewdate == old.viewdate:
+                    continue
+                mylist = MyList(mylist.lid, values['fid'], values['eid'], values['aid'], values['gid'], values['date'],
+                                values['state'], viewdate)
+            changed.append(mylist)
+        self.query.insert_mylists(changed)
+        self.conn.commit()
+        return len(entries), len(changed)
+
     def fill_files(self) -> None:
         for local in self.query.get_unchecked_local_files():
             self.get_file(local)
@@ -89,8 +194,23 @@ class LocalDB:
             self.get_mylist(fid)
 
     def _path_to_rel(self, path: str) -> DbRelPath:
-        real = os.path.realpath(path)
-        return DbRelPath(os.path.relpath(real, self.base_anime_folder))
+        if not os.path.isabs(path) or path.endswith(os.sep):
+            path = os.path.abspath(path)
+        directory, name = os.path.split(path)
+        if os.path.islink(path) or name in ('', os.curdir, os.pardir):
+            return DbRelPath(os.path.relpath(os.path.realpath(path), self.base_anime_folder))
+        # realpath checks every path component for symlinks, so only resolve each directory once
+        cached = self._rel_dirs.get(directory)
+        if cached is None:
+            real_dir = os.path.realpath(directory)
+            cached = self._rel_dirs[directory] = (real_dir, os.path.relpath(real_dir, self.base_anime_folder))
+        real_dir, rel_dir = cached
+        if rel_dir == os.curdir:
+            return DbRelPath(name)
+        if rel_dir == os.pardir or rel_dir.startswith(os.pardir + os.sep):
+            # Outside the base folder, so the name might lead back in
+            return DbRelPath(os.path.relpath(os.path.join(real_dir, name), self.base_anime_folder))
+        return DbRelPath(os.path.join(rel_dir, name))
 
     def delete_local(self, files: Iterable[str]) -> None:
         for file in files:
@@ -102,43 +222,354 @@ class LocalDB:
             rel = self._path_to_rel(file)
             self.query.force_recheck(rel)
 
-    def get_local_files(self, files: Iterable[str]) -> Iterable[LocalFileInfo]:
-        c = self.conn.cursor()
-        unhashed = list()
-        for file in files:
-            rel = self._path_to_rel(file)
-            local = self.query.get_local_file_from_path(rel)
-            if local:
-                yield local
-            else:
-                unhashed.append(file)
+    def scan_directories(self, paths: Iterable[str], suffixes: List[str], full: bool=False, num_threads: int=8) -> List[str]:
+        '''
+        Find video files under paths. Unless full, directories unchanged since the last saved scan aren't listed
+        (their files were already found then)
+        '''
+        self.scanned_suffixes = ' '.join(sorted(set(suffixes)))
+        if self.query.get_setting('scan-suffixes') != self.scanned_suffixes:
+            # Files with a newly added suffix could be in any directory, including the unchanged ones
+            self.query.delete_directories()
+        known = dict()
+        if not full:
+            for rel, mtime_ns, entries, subdirs in self.query.get_directories():
+                known[rel] = DirState(rel, mtime_ns, entries, subdirs)
+        files, self.scanned_directories, skipped = scan_tree(paths, suffixes, known, self._path_to_rel, num_threads)
+        if skipped:
+            print(f'Skipped {skipped} unchanged directories')
+        return files
+
+    def save_scanned_directories(self) -> None:
+        '''Record the directories from scan_directories, call once their files have all been imported'''
+        for state in self.scanned_directories:
+            rel = self._path_to_rel(state.path)
+            # An mtime that never matches, so the directory is listed again
+            mtime_ns = -1 if rel in self.failed_directories else state.mtime_ns
+            self.query.insert_directory(rel, mtime_ns, state.entries, state.subdirs)
+        self.query.set_setting('scan-suffixes', self.scanned_suffixes)
+        self.scanned_directories = []
+        self.failed_directories.clear()
+
+    def _file_failed(self, rel: DbRelPath) -> None:
+        '''Note that rel couldn't be imported, so it's tried again on the next scan'''
+        self.failed_directories.add(DbRelPath(os.path.dirname(rel) or os.curdir))
 
-        hashed_files = hash_files(unhashed)
+    def get_local_files(self, files: Iterable[str], num_threads: int=DEFAULT_HASH_THREADS,
+            chunk_threads: int=1, block_size: int=DEFAULT_BLOCK_SIZE, per_device: int=DEFAULT_READERS_PER_DEVICE,
+            small_first: bool=False) -> Iterable[LocalFileInfo]:
+        known, unhashed, resume = self._prepare_local_files(files, block_size)
+        yield from known
+
+        hashed_files = hash_files(unhashed, num_threads, chunk_threads, block_size, resume, self._save_hash_checkpoint,
+                                 per_device, small_first, lambda name, e: self._file_failed(self._path_to_rel(name)))
         for h in hashed_files:
-            local = LocalFileInfo(self._path_to_rel(h.name), h.size, h.ed2k)
-            self.query.insert_local_file(local.path, local.size, local.ed2k)
-            yield local
+            yield self._store_hashed_file(h)
 
-    def is_file_known(self, file: str) -> bool:
-        rel = self._path_to_rel(file)
-        local = self.query.get_local_file_from_path(rel)
-        if not local:
+    def verify_quick_hash_matches(self, num_threads: int=DEFAULT_HASH_THREADS, chunk_threads: int=1,
+            block_size: int=DEFAULT_BLOCK_SIZE, per_device: int=DEFAULT_READERS_PER_DEVICE) -> List[LocalFileInfo]:
+        '''
+        Fully hash the files only matched by quick hash (see _find_quick_hash_match), which were imported without
+        reading all of them, returns the new entries of any that turned out to be different files
+        '''
+        files = [os.path.join(self.base_anime_folder, path) for path in self.query.get_unverified_paths()]
+        files = [file for file in files if os.path.exists(file)]
+        wrong = []
+        for h in hash_files(files, num_threads, chunk_threads, block_size, None, self._save_hash_checkpoint, per_device,
+                            on_error=lambda name, e: self._file_failed(self._path_to_rel(name))):
+            old = self.query.get_local_file_from_path(self._path_to_rel(h.name))
+            local = self._store_hashed_file(h)
+            if not old or old.ed2k != local.ed2k:
+                wrong.append(local)
+        self.conn.commit()
+        return wrong
+
+    def import_files(self, files: Iterable[str], num_threads: int=DEFAULT_HASH_THREADS,
+            chunk_threads: int=1, block_size: int=DEFAULT_BLOCK_SIZE, per_device: int=DEFAULT_READERS_PER_DEVICE,
+            small_first: bool=False) -> Iterator[Tuple[LocalFileInfo, Optional[FileInfo], Optional[AniDBError]]]:
+        '''
+        get_local_files then get_file for each file, but pipelined: hashing runs in its own threads, AniDB
+        requests in another, and this thread does the DB writes, all connected by queues
+        Files with the same size and ed2k (or fid) share a single FILE request, and a single MYLISTADD per fid,
+        counted in saved_requests
+        Yields (local file, its info or None if unknown, error for just this file) in the order they complete
+        '''
+        known, unhashed, resume = self._prepare_local_files(files, block_size)
+        events: 'queue.Queue[Tuple[str, Any]]' = queue.Queue()
+        # Bounded, the rate limited AniDB requests are the slowest stage
+        requests: 'queue.Queue[Optional[Tuple[str, Any, Callable[[], Any]]]]' = queue.Queue(maxsize=NETWORK_QUEUE_SIZE)
+
+        def hash_stage() -> None:
+            try:
+                for h in hash_files(unhashed, num_threads, chunk_threads, block_size, resume,
+                                    lambda checkpoint: events.put(('checkpoint', checkpoint)), per_device, small_first,
+                                    lambda name, e: events.put(('hash error', name))):
+                    events.put(('hashed', h))
+            except BaseException as e:
+                events.put(('error', e))
+            finally:
+                events.put(('hashing done', None))
+
+        def network_stage() -> None:
+            while True:
+                request = requests.get()
+                if request is None:
+                    return
+                kind, key, call = request
+                try:
+                    events.put((kind, (key, call())))
+                except (AniDBUnknownFile, AniDBNotInMylist) as e:
+                    events.put((kind + ' error', (key, e)))
+                except BaseException as e:
+                    events.put(('error', e))
+
+        threading.Thread(target=hash_stage, daemon=True).start()
+        threading.Thread(target=network_stage, daemon=True).start()
+
+        # Files waiting on each FILE request (by lookup key) and MYLISTADD (by fid) in flight
+        lookups: Dict[Tuple[Any, ...], List[LocalFileInfo]] = dict()
+        mylist_adds: Dict[Fid, List[LocalFileInfo]] = dict()
+        # FILE replies so far, for files that turn up after the request finished
+        answered: Dict[Tuple[Any, ...], Optional[ApiDict]] = dict()
+        finished: List[Tuple[LocalFileInfo, Optional[FileInfo], Optional[AniDBError]]] = []
+
+        def identified(local: LocalFileInfo) -> None:
+            '''local is known to AniDB, make sure it's in mylist'''
+            if self.query.get_mylist_from_fid(local.fid):
+                finished.append((local, self.query.get_file_from_local(local), None))
+            elif local.fid in mylist_adds:
+                mylist_adds[local.fid].append(local)
+                self.saved_requests += 1
+            else:
+                mylist_adds[local.fid] = [local]
+                requests.put(('mylist', local.fid, functools.partial(self._add_mylist, local.fid)))
+
+        def looked_up(local: LocalFileInfo, info: Optional[ApiDict]) -> None:
+            if self._store_file_info(local, info):
+                identified(local)
+            else:
+                finished.append((local, None, None))
+
+        hashing = True
+        ready: List[LocalFileInfo] = list(known)
+        try:
+            while True:
+                # Send off (or finish) every file whose next step is known
+                for local in ready:
+                    file = self.query.get_file_from_local(local)
+                    if file or local.checked:
+                        finished.append((local, file, None))
+                        continue
+                    key = self._lookup_key(local)
+                    if key in lookups:
+                        lookups[key].append(local)
+                        self.saved_requests += 1
+                    elif key in answered:
+                        looked_up(local, answered[key])
+                        self.saved_requests += 1
+                    elif self._resolve_duplicate(local):
+                        self.saved_requests += 1
+                        identified(local)
+                    else:
+                        lookups[key] = [local]
+                        requests.put(('file', key, functools.partial(self._lookup_file, local)))
+                ready = []
+                yield from finished
+                finished.clear()
+
+                if not hashing and not lookups and not mylist_adds:
+                    break
+                kind, value = events.get()
+                if kind == 'hashing done':
+                    hashing = False
+                elif kind == 'hashed':
+                    ready.append(self._store_hashed_file(value))
+                elif kind == 'checkpoint':
+                    self._save_hash_checkpoint(value)
+                elif kind == 'hash error':
+                    self._file_failed(self._path_to_rel(value))
+                elif kind == 'error':
+                    raise value
+                elif kind == 'file':
+                    key, info = value
+                    answered[key] = info
+                    for local in lookups.pop(key):
+                        looked_up(local, info)
+                elif kind == 'file error':
+                    key, error = value
+                    for local in lookups.pop(key):
+                        self._file_failed(local.path)
+                        finished.append((local, None, error))
+                elif kind == 'mylist':
+                    fid, mylist = value
+                    self.query.insert_mylist(mylist)
+                    finished += [(local, self.query.get_file_from_local(local), None) for local in mylist_adds.pop(fid)]
+                elif kind == 'mylist error':
+                    fid, error = value
+                    for local in mylist_adds.pop(fid):
+                        self._file_failed(local.path)
+                        finished.append((local, None, error))
+        finally:
+            try:
+                requests.put_nowait(None)
+            except queue.Full:
+                pass
+
+    @staticmethod
+    def _lookup_key(local: LocalFileInfo) -> Tuple[Any, ...]:
+        '''What a FILE request for local asks about, files with the same key get the same reply'''
+        if local.fid > 0:
+            return ('fid', local.fid)
+        return ('ed2k', local.size, local.ed2k)
+
+    def _resolve_duplicate(self, local: LocalFileInfo) -> bool:
+        '''Identify local from another copy of the same file that's already identified, instead of asking AniDB'''
+        if local.fid > 0:
+            return False
+        fid = self.query.get_identified_fid(local.size, local.ed2k)
+        if not fid:
             return False
+        local.fid = fid
+        local.checked = True
+        self.query.update_local_checked(local)
         return True
 
+    def _prepare_local_files(self, files: Iterable[str],
+            block_size: int=DEFAULT_BLOCK_SIZE) -> Tuple[List[LocalFileInfo], List[str], Dict[str, HashCheckpoint]]:
+        '''
+        Split files into those already in the DB and those to hash, with any checkpoints to resume hashing from
+        Files matched by quick hash count as already in the DB, verify_quick_hash_matches confirms them later
+        '''
+        known_files = list()
+        unhashed = list()
+        resume: Dict[str, HashCheckpoint] = dict()
+        rels = {file: self._path_to_rel(file) for file in files}
+        known = self.query.get_local_files_from_paths(rels.values())
+        for file, rel in rels.items():
+            try:
+                local = known.get(rel) or self._find_moved_file(file, rel)
+                if local:
+                    known_files.append(local)
+                    continue
+                st = os.stat(file)
+                digests = self.query.get_hash_checkpoint(rel, st.st_size, st.st_mtime_ns)
+                if digests:
+                    resume[file] = HashCheckpoint(file, st.st_size, st.st_mtime_ns,
+                                                  [digests[i:i + 16] for i in range(0, len(digests), 16)])
+                else:
+                    local = self._find_quick_hash_match(file, rel, block_size)
+                    if local:
+                        known_files.append(local)
+                        continue
+                unhashed.append(file)
+            except OSError as e:
+                # Deleted since it was listed, a dangling symlink, ...
+                print(f'Error reading {file}: {e}')
+                self._file_failed(rel)
+        return known_files, unhashed, resume
+
+    def _find_quick_hash_match(self, file: str, rel: DbRelPath, block_size: int) -> Optional[LocalFileInfo]:
+        '''
+        Look for an already hashed file that no longer exists, with the same size and quick hash, and if
+        found carry its hash and fid over to the new path, marked as unverified until it's fully hashed
+        (by verify_quick_hash_matches)
+        Catches files that were copied back from a backup or moved across filesystems
+        '''
+        st = os.stat(file)
+        size = st.st_size
+        candidates = [(path, quickhash) for path, quickhash in self.query.get_quick_hashes_for_size(size)
+                      if not os.path.exists(os.path.join(self.base_anime_folder, path))]
+        if not candidates:
+            return None
+        quickhash = quick_hash(file, block_size)
+        for old_path, old_quickhash in candidates:
+            old = self.query.get_local_file_from_path(old_path)
+            if old_quickhash != quickhash or not old:
+                continue
+            local = LocalFileInfo(rel, old.size, old.ed2k, old.fid, old.checked)
+            self.query.insert_local_file(local.path, local.size, local.ed2k, local.fid, local.checked)
+            self.query.delete_local(old_path)
+            self.query.insert_file_stat(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, rel)
+            self.query.insert_quick_hash(rel, size, quickhash, verified=False)
+            return local
+        return None
+
+    def _store_hashed_file(self, h: HashedFile) -> LocalFileInfo:
+        '''Record a newly hashed file, returns its entry (the existing one if it confirmed a quick hash match)'''
+        rel = self._path_to_rel(h.name)
+        self.query.insert_file_stat(h.dev, h.inode, h.size, h.mtime_ns, rel)
+        self.query.delete_hash_checkpoint(rel)
+        old = self.query.get_local_file_from_path(rel)
+        self.query.insert_quick_hash(rel, h.size, h.quickhash)
+        if old and old.size == h.size and old.ed2k == h.ed2k:
+            return old
+        if old:
+            print(f'Quick hash match was wrong, rehashed: {rel}')
+        local = LocalFileInfo(rel, h.size, h.ed2k)
+        self.query.insert_local_file(local.path, local.size, local.ed2k)
+        return local
+
+    def _save_hash_checkpoint(self, checkpoint: HashCheckpoint) -> None:
+        rel = self._path_to_rel(checkpoint.name)
+        self.query.insert_hash_checkpoint(rel, checkpoint.size, checkpoint.mtime_ns, checkpoint.offset,
+                                          b''.join(checkpoint.chunk_digests))
+        # Commit now, so the progress survives the process being killed
+        self.conn.commit()
+
+    def _find_moved_file(self, file: str, rel: DbRelPath) -> Optional[LocalFileInfo]:
+        '''
+        Look for an already hashed file with the same device/inode/size/mtime, and if found carry
+        its hash and fid over to the new path
+        '''
+        st = os.stat(file)
+        old_path = self.query.get_path_from_stat(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        if old_path is None:
+            return None
+        old = self.query.get_local_file_from_path(old_path)
+        if not old or old.size != st.st_size:
+            return None
+        local = LocalFileInfo(rel, old.size, old.ed2k, old.fid, old.checked)
+        self.query.insert_local_file(local.path, local.size, local.ed2k, local.fid, local.checked)
+        quickhash = self.query.get_quick_hash(old_path)
+        if quickhash:
+            self.query.insert_quick_hash(rel, old.size, *quickhash)
+        if not os.path.exists(os.path.join(self.base_anime_folder, old_path)):
+            # Moved rather than hard linked, so the old entry is gone
+            self.query.delete_local(old_path)
+        self.query.insert_file_stat(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, rel)
+        return local
+
+    def filter_unknown_files(self, files: Iterable[str]) -> List[str]:
+        '''
+        The files that haven't been hashed into the DB yet, looked up all at once
+        Quick hash matches count as hashed, verify_quick_hash_matches hashes those still unverified
+        '''
+        rels = {file: self._path_to_rel(file) for file in files}
+        known = self.query.get_local_files_from_paths(rels.values())
+        missing_stats = set(self.query.get_paths_without_file_stat())
+        unknown = []
+        for file, rel in rels.items():
+            if rel not in known:
+                unknown.append(file)
+            elif rel in missing_stats:
+                # Hashed before fingerprints were recorded, record it now so it can be tracked if moved
+                try:
+                    st = os.stat(file)
+                except OSError as e:
+                    print(f'Error reading {file}: {e}')
+                    continue
+                self.query.insert_file_stat(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, rel)
+        return unknown
+
+    def is_file_known(self, file: str) -> bool:
+        return not self.filter_unknown_files([file])
+
     def get_playnext_file(self) -> Optional[LocalEpisodeInfo]:
         return self.query.get_playnext_file()
 
     def increment_playnext(self, playnext: LocalEpisodeInfo) -> Optional[LocalEpisodeInfo]:
-        try:
-            code = ''
-            epnum = int(playnext.epno)
-        except ValueError:
-            code = playnext.epno[0]
-            epnum = int(playnext.epno[1:])
-        epnum += 1
-        new_epno = f'^{code}0*{epnum}$'
-        nextInfo = self.query.get_playnext_for_episode(playnext.aid, new_epno)
+        code, epnum = split_epno(playnext.epno)
+        nextInfo = self.query.get_playnext_for_episode(playnext.aid, code, epnum + 1)
         self.query.delete_playnext()
         if nextInfo:
             self.query.insert_playnext(nextInfo.aid, nextInfo.epno)
@@ -0,0 +1,160 @@
+"""
+MD4 implemented with NumPy, for systems where hashlib can't provide md4
+(OpenSSL 3 without the legacy provider)
+
+A single MD4 can't be vectorised, as each 64 byte block depends on the previous one. Instead many
+independent messages (ed2k chunks) are hashed in lockstep, with each uint32 array element holding
+the state of one message. The cost of each step barely depends on the number of messages, so
+throughput grows with the number hashed together.
+"""
+import io
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # type: ignore[assignment]
+
+from typing import List, Optional, Sequence, Union
+
+
+# Chunks buffered by Ed2k before hashing them together - each is up to 9500 KiB, so this bounds memory use
+BATCH_SIZE = 16
+
+# Memory for the slab of one hash_file_chunks call, which reads slab_size bytes of every chunk at a time
+SLAB_BUDGET = 8 * 1024 * 1024
+
+_INIT = (0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476)
+
+# (word index, shift) for each step of the 3 rounds
+_ROUND1 = [(k, (3, 7, 11, 19)[k % 4]) for k in range(16)]
+_ROUND2 = [(k, (3, 5, 9, 13)[i % 4]) for i, k in enumerate((0, 4, 8, 12, 1, 5, 9, 13, 2, 6, 10, 14, 3, 7, 11, 15))]
+_ROUND3 = [(k, (3, 9, 11, 15)[i % 4]) for i, k in enumerate((0, 8, 4, 12, 2, 10, 6, 14, 1, 9, 5, 13, 3, 11, 7, 15))]
+
+
+def available() -> bool:
+    return numpy is not None
+
+
+def _rotl(x: 'numpy.ndarray', s: int) -> 'numpy.ndarray':
+    return (x << numpy.uint32(s)) | (x >> numpy.uint32(32 - s))
+
+
+def _compress(state: List['numpy.ndarray'], x: List['numpy.ndarray']) -> List['numpy.ndarray']:
+    a, b, c, d = state
+    for k, s in _ROUND1:
+        a, b, c, d = d, _rotl(a + (d ^ (b & (c ^ d))) + x[k], s), b, c
+    k2 = numpy.uint32(0x5A827999)
+    for k, s in _ROUND2:
+        a, b, c, d = d, _rotl(a + ((b & c) | (d & (b | c))) + x[k] + k2, s), b, c
+    k3 = numpy.uint32(0x6ED9EBA1)
+    for k, s in _ROUND3:
+        a, b, c, d = d, _rotl(a + (b ^ c ^ d) + x[k] + k3, s), b, c
+    return [state[0] + a, state[1] + b, state[2] + c, state[3] + d]
+
+
+def _padded_tail(tail: bytes, length: int) -> bytes:
+    """The final partial block of a message with the MD4 padding added - 64 or 128 bytes"""
+    pad = b'\x80' + b'\x00' * ((55 - length) % 64)
+    return tail + pad + struct.pack('<Q', length * 8)
+
+
+class LockstepMD4:
+    """Running MD4 of several messages at once, fed whole 64 byte blocks"""
+    def __init__(self, lanes: int):
+        if numpy is None:
+            raise ValueError('numpy is required for the fallback md4 implementation')
+        self.lanes = lanes
+        self.state = [numpy.full(lanes, v, dtype=numpy.uint32) for v in _INIT]
+
+    def update(self, data: 'numpy.ndarray', num_blocks: Optional[Sequence[int]]=None) -> None:
+        """
+        data is a uint8 array of shape (lanes, n * 64), one row per message
+        num_blocks limits how many of the blocks in each row are used (default all)
+        """
+        if not data.shape[1]:
+            return
+        words = data.view('<u4').reshape(self.lanes, -1, 16)
+        blocks = numpy.asarray(num_blocks) if num_blocks is not None else None
+        for block in range(words.shape[1]):
+            # Words of this block, one contiguous array per word index
+            x = list(numpy.ascontiguousarray(words[:, block, :].T))
+            new_state = _compress(self.state, x)
+            if blocks is None or (blocks > block).all():
+                self.state = new_state
+            else:
+                active = blocks > block
+                self.state = [numpy.where(active, new, old) for new, old in zip(new_state, self.state)]
+
+    def finish(self, tails: Sequence[bytes], lengths: Sequence[int]) -> List[bytes]:
+        """
+        Hash the last partial block (less than 64 bytes) and total length of each message
+        Returns the digest of each
+        """
+        padded = [_padded_tail(tail, length) for tail, length in zip(tails, lengths)]
+        data = numpy.zeros((self.lanes, 128), dtype=numpy.uint8)
+        for i, p in enumerate(padded):
+            data[i, :len(p)] = numpy.frombuffer(p, dtype=numpy.uint8)
+        self.update(data, [len(p) // 64 for p in padded])
+        return [struct.pack('<4I', *(int(s[i]) for s in self.state)) for i in range(self.lanes)]
+
+
+def md4_many(messages: Sequence[Union[bytes, bytearray, memoryview]]) -> List[bytes]:
+    """MD4 digest of each message, all hashed in lockstep"""
+    if not messages:
+        return []
+    lengths = [len(m) for m in messages]
+    full_blocks = [length // 64 for length in lengths]
+    data = numpy.zeros((len(messages), max(full_blocks) * 64), dtype=numpy.uint8)
+    for i, m in enumerate(messages):
+        if full_blocks[i]:
+            data[i, :full_blocks[i] * 64] = numpy.frombuffer(m, dtype=numpy.uint8, count=full_blocks[i] * 64)
+    hasher = LockstepMD4(len(messages))
+    hasher.update(data, full_blocks)
+    return hasher.finish([bytes(m[full_blocks[i] * 64:]) for i, m in enumerate(messages)], lengths)
+
+
+def max_lanes(slab_size: int) -> int:
+    """Chunks of one file to hash together, so their slab fits in SLAB_BUDGET"""
+    return max(1, SLAB_BUDGET // slab_size)
+
+
+def _readinto_exact(f: io.FileIO, view: memoryview) -> None:
+    pos = 0
+    while pos < len(view):
+        read = f.readinto(view[pos:])
+        if not read:
+            raise OSError(f'Unexpected end of file: {f.name}')
+        pos += read
+
+
+def hash_file_chunks(f: io.FileIO, offsets: Sequence[int], lengths: Sequence[int], slab_size: int) -> List[bytes]:
+    """
+    MD4 digest of each region (offset, length) of f, hashed in lockstep
+    Each region is read slab_size bytes at a time, so memory use is len(offsets) * slab_size
+    """
+    slab_size = max(64, slab_size - slab_size % 64)
+    lanes = len(offsets)
+    hasher = LockstepMD4(lanes)
+    slab = numpy.zeros((lanes, slab_size), dtype=numpy.uint8)
+    full_bytes = [length - length % 64 for length in lengths]
+    pos = 0
+    while pos < max(full_bytes):
+        size = min(slab_size, max(full_bytes) - pos)
+        num_blocks = []
+        for i in range(lanes):
+            want = max(0, min(size, full_bytes[i] - pos))
+            if want:
+                f.seek(offsets[i] + pos)
+                _readinto_exact(f, memoryview(slab[i])[:want])
+            num_blocks.append(want // 64)
+        hasher.update(slab[:, :size], num_blocks)
+        pos += size
+
+    tails = []
+    for i in range(lanes):
+        f.seek(offsets[i] + full_bytes[i])
+        tail = memoryview(bytearray(lengths[i] - full_bytes[i]))
+        _readinto_exact(f, tail)
+        tails.append(bytes(tail))
+    return hasher.finish(tails, lengths)
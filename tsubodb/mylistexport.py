@@ -0,0 +1,157 @@
+"""
+Reading MyList exports (from the export page of the AniDB website), so a whole MyList can be loaded
+without a MYLIST request per file
+
+Export templates differ in their columns, so any CSV/TSV table with a header row naming at least the
+lid and fid columns is accepted, either as a plain file or inside a .tgz/.tar.gz/.zip archive.
+Each entry comes with the fields the export actually gave a value for, the rest of its MyList is 0.
+"""
+import calendar
+import csv
+import io
+import tarfile
+import time
+import zipfile
+
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from tsubodb.types import *
+
+
+# Header names (lower case, without spaces/underscores) of each MyList field
+COLUMN_ALIASES: Dict[str, Tuple[str, ...]] = {
+    'lid': ('lid', 'mylistid', 'mlid', 'listid'),
+    'fid': ('fid', 'fileid'),
+    'eid': ('eid', 'epid', 'episodeid'),
+    'aid': ('aid', 'animeid'),
+    'gid': ('gid', 'groupid'),
+    'date': ('date', 'added', 'addeddate', 'mylistdate', 'mldate'),
+    'state': ('state', 'mystate', 'mlstate', 'storage', 'storagestate'),
+    'viewdate': ('viewdate', 'vieweddate', 'mlviewdate', 'watcheddate'),
+    'viewed': ('viewed', 'watched', 'mlviewed'),
+}
+
+# Words in a text storage state, and the state number they mean
+STATE_WORDS = (('deleted', 3), ('remote', 4), ('internal', 1), ('hdd', 1), ('external', 2), ('cd', 2), ('dvd', 2))
+
+TABLE_SUFFIXES = ('.csv', '.tsv', '.txt')
+
+# A MyList entry, and the names of its fields the export gave a value for
+# A watched flag without a date gives 'viewed' rather than 'viewdate', and a guessed viewdate
+ExportEntry = Tuple[MyList, Set[str]]
+
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%d.%m.%Y')
+
+
+def _normalise(name: str) -> str:
+    return ''.join(c for c in name.lower() if c.isalnum())
+
+
+def _parse_date(value: str) -> int:
+    '''Unix time from either a number or a date string (taken as UTC), 0 when empty'''
+    value = value.strip()
+    if not value or value in ('-', '0'):
+        return 0
+    if value.isdigit():
+        return int(value)
+    for date_format in DATE_FORMATS:
+        try:
+            return calendar.timegm(time.strptime(value, date_format))
+        except ValueError:
+            pass
+    raise ValueError(f'Unknown date: {value}')
+
+
+def _parse_state(value: str) -> int:
+    value = value.strip().lower()
+    if not value:
+        return 0
+    if value.isdigit():
+        return int(value)
+    for word, state in STATE_WORDS:
+        if word in value:
+            return state
+    return 0
+
+
+def _parse_int(value: str) -> int:
+    value = value.strip()
+    return int(value) if value.isdigit() else 0
+
+
+def parse_table(text: str) -> Optional[List[ExportEntry]]:
+    '''MyList entries in a CSV/TSV table, or None if it doesn't look like a MyList export'''
+    first_line = text.split('\n', 1)[0]
+    try:
+        dialect = csv.Sniffer().sniff(first_line, delimiters=',\t;|')
+    except csv.Error:
+        return None
+    rows = csv.reader(io.StringIO(text), dialect)
+    header = next(rows, None)
+    if not header:
+        return None
+    names = [_normalise(name) for name in header]
+    columns: Dict[str, int] = dict()
+    for field, aliases in COLUMN_ALIASES.items():
+        for i, name in enumerate(names):
+            if name in aliases:
+                columns[field] = i
+                break
+    if 'lid' not in columns or 'fid' not in columns:
+        return None
+
+    def get(row: List[str], field: str) -> str:
+        i = columns.get(field)
+        return row[i] if i is not None and i < len(row) else ''
+
+    entries = []
+    for row in rows:
+        if not row or not get(row, 'lid').strip().isdigit():
+            continue
+        given = {field for field in columns if get(row, field).strip()}
+        date = _parse_date(get(row, 'date'))
+        viewdate = _parse_date(get(row, 'viewdate'))
+        given.discard('viewed')
+        if not viewdate and get(row, 'viewed').strip().lower() in ('1', 'yes', 'true', 'y'):
+            # Watched, but when isn't exported
+            viewdate = date or 1
+            given.discard('viewdate')
+            given.add('viewed')
+        entries.append((MyList(Lid(int(get(row, 'lid'))), Fid(_parse_int(get(row, 'fid'))), Eid(_parse_int(get(row, 'eid'))),
+                               Aid(_parse_int(get(row, 'aid'))), Gid(_parse_int(get(row, 'gid'))), date,
+                               _parse_state(get(row, 'state')), viewdate), given))
+    return entries
+
+
+def _tables(path: str) -> Iterator[Tuple[str, str]]:
+    '''(name, text) of each table in an export file or archive'''
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as z:
+            for name in z.namelist():
+                if name.lower().endswith(TABLE_SUFFIXES):
+                    yield name, z.read(name).decode('utf-8-sig', errors='replace')
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path) as tar:
+            for member in tar:
+                if member.isfile() and member.name.lower().endswith(TABLE_SUFFIXES):
+                    member_file = tar.extractfile(member)
+                    if member_file is not None:
+                        with member_file:
+                            yield member.name, member_file.read().decode('utf-8-sig', errors='replace')
+    else:
+        with open(path, encoding='utf-8-sig', errors='replace') as text_file:
+            yield path, text_file.read()
+
+
+def read_mylist_export(path: str) -> List[ExportEntry]:
+    '''Every MyList entry in an export, raises ValueError if it has none in a recognised format'''
+    entries: List[ExportEntry] = []
+    found = False
+    for name, text in _tables(path):
+        table = parse_table(text)
+        if table is not None:
+            found = True
+            entries += table
+    if not found:
+        raise ValueError(f'No MyList table (with lid and fid columns) found in {path}')
+    return entries
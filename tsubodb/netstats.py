@@ -0,0 +1,100 @@
+"""
+Counters and timings of the requests sent to AniDB, to see where a long run spends its time
+"""
+import json
+import threading
+
+from typing import Any, Dict
+
+
+# Upper bounds in seconds of the round trip time histogram buckets, the last one has no upper bound
+RTT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+
+class CommandStats:
+    def __init__(self) -> None:
+        self.requests = 0  # Requests made, including cached ones
+        self.cached = 0  # Answered from the cache, without sending
+        self.packets = 0  # Packets sent, including retries
+        self.replies = 0
+        self.timeouts = 0  # Packets that got no reply in time
+        self.retries = 0
+        self.reauths = 0  # Replies saying the session had expired (501/506), so a login was needed
+        self.rate_limit_wait = 0.0  # Seconds spent waiting for the rate limit before sending
+        self.rtt_total = 0.0
+        self.rtt_max = 0.0
+        self.rtt_histogram = [0] * (len(RTT_BUCKETS) + 1)
+        self.codes: Dict[int, int] = dict()  # Replies by code
+
+    def as_dict(self) -> Dict[str, Any]:
+        labels = [f'<={bound}' for bound in RTT_BUCKETS] + [f'>{RTT_BUCKETS[-1]}']
+        return {
+            'requests': self.requests,
+            'cached': self.cached,
+            'packets': self.packets,
+            'replies': self.replies,
+            'timeouts': self.timeouts,
+            'retries': self.retries,
+            'reauths': self.reauths,
+            'rate_limit_wait': round(self.rate_limit_wait, 3),
+            'rtt_mean': round(self.rtt_total / self.replies, 4) if self.replies else None,
+            'rtt_max': round(self.rtt_max, 4),
+            'rtt_histogram': dict(zip(labels, self.rtt_histogram)),
+            'codes': {str(code): count for code, count in sorted(self.codes.items())},
+        }
+
+
+class NetStats:
+    """Per command statistics, safe to update from any thread"""
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.commands: Dict[str, CommandStats] = dict()
+
+    def _get(self, cmd: str) -> CommandStats:
+        if cmd not in self.commands:
+            self.commands[cmd] = CommandStats()
+        return self.commands[cmd]
+
+    def request(self, cmd: str, cached: bool=False) -> None:
+        with self.lock:
+            stats = self._get(cmd)
+            stats.requests += 1
+            if cached:
+                stats.cached += 1
+
+    def sent(self, cmd: str, rate_limit_wait: float, retry: bool=False) -> None:
+        with self.lock:
+            stats = self._get(cmd)
+            stats.packets += 1
+            stats.rate_limit_wait += rate_limit_wait
+            if retry:
+                stats.retries += 1
+
+    def reply(self, cmd: str, code: int, rtt: float) -> None:
+        with self.lock:
+            stats = self._get(cmd)
+            stats.replies += 1
+            stats.codes[code] = stats.codes.get(code, 0) + 1
+            stats.rtt_total += rtt
+            stats.rtt_max = max(stats.rtt_max, rtt)
+            bucket = next((i for i, bound in enumerate(RTT_BUCKETS) if rtt <= bound), len(RTT_BUCKETS))
+            stats.rtt_histogram[bucket] += 1
+            if code in (501, 506):
+                stats.reauths += 1
+
+    def timeout(self, cmd: str) -> None:
+        with self.lock:
+            self._get(cmd).timeouts += 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            commands = {cmd: stats.as_dict() for cmd, stats in sorted(self.commands.items())}
+        totals: Dict[str, Any] = dict()
+        for name in ('requests', 'cached', 'packets', 'replies', 'timeouts', 'retries', 'reauths', 'rate_limit_wait'):
+            totals[name] = sum(stats[name] for stats in commands.values())
+        totals['rate_limit_wait'] = round(totals['rate_limit_wait'], 3)
+        return {'total': totals, 'commands': commands}
+
+    def dump(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
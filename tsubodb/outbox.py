@@ -0,0 +1,139 @@
+"""
+Write-behind sending of MyList changes to AniDB
+
+LocalDB applies a change (e.g. marking an episode watched) to its own tables straight away and queues
+it in the Outbox table. OutboxFlusher sends the queue from a background thread, with its own DB
+connection, so nothing waits on the rate limited network, and changes made offline are sent later.
+It logs in itself when the username and password are available without asking for them, otherwise the
+changes wait for the main thread to log in (LocalDB.stop_outbox does at exit).
+"""
+import sqlite3
+import threading
+
+from typing import Dict, List, Optional, Tuple
+
+from tsubodb.api import AniDB
+from tsubodb.types import *
+from tsubodb._query import _Query
+
+
+# Seconds before retrying after a failure, doubling with each one up to MAX_RETRY_INTERVAL
+RETRY_INTERVAL = 30.0
+MAX_RETRY_INTERVAL = 30 * 60.0
+
+# Seconds to wait for the main connection to release the DB
+LOCK_TIMEOUT = 1.0
+
+# Seconds to wait for queued changes to be sent when exiting
+STOP_TIMEOUT = 30.0
+
+# Outbox kinds
+WATCHED = 'watched'  # Mark the MyList entry lid watched
+ADD_WATCHED = 'add'  # Add fid to MyList as watched, replacing the placeholder entry made for it
+
+
+def _server_error(e: AniDBReplyError) -> bool:
+    '''Whether the reply was a server side problem (busy, banned, ...) rather than about the request'''
+    code = e.args[0] if e.args else None
+    return isinstance(code, int) and code >= 500
+
+
+class OutboxFlusher(threading.Thread):
+    def __init__(self, db_file: str, anidb: AniDB, retry_interval: float=RETRY_INTERVAL):
+        super().__init__(daemon=True)
+        self.db_file = db_file
+        self.anidb = anidb
+        self.retry_interval = retry_interval
+        self.wake = threading.Event()
+        self.stopping = False
+        self.sent = 0
+        # Whether the last attempt failed for want of a session (see AniDBLoginError)
+        self.needs_login = False
+
+    def run(self) -> None:
+        conn = sqlite3.connect(self.db_file, timeout=LOCK_TIMEOUT)
+        query = _Query(conn)
+        failures = 0
+        # Changes can be left from an earlier run, so start by sending those
+        delay: Optional[float] = 0.0
+        try:
+            while True:
+                self.wake.wait(delay)
+                self.wake.clear()
+                if self.stopping and failures and not (self.needs_login and self.anidb.session):
+                    # Probably offline, don't hold up exiting, it's all still queued for next time
+                    return
+                sent_all = self._flush(conn, query)
+                if self.stopping:
+                    return
+                if sent_all:
+                    failures = 0
+                    delay = None
+                else:
+                    failures += 1
+                    delay = min(MAX_RETRY_INTERVAL, self.retry_interval * 2 ** (failures - 1))
+        finally:
+            conn.close()
+
+    def stop(self, timeout: Optional[float]=None) -> None:
+        '''Make one last attempt to send everything queued, waiting up to timeout seconds for it'''
+        self.stopping = True
+        self.wake.set()
+        self.join(timeout)
+
+    def _flush(self, conn: sqlite3.Connection, query: _Query) -> bool:
+        '''Send everything queued, returns False if it has to be tried again later'''
+        try:
+            rows = query.get_outbox()
+        except sqlite3.OperationalError:
+            return False
+        # Repeated changes to the same entry only need sending once
+        groups: Dict[Tuple[str, int], List[int]] = dict()
+        for row_id, kind, fid, lid in rows:
+            key = (kind, int(lid)) if kind == WATCHED and lid is not None else (kind, int(fid))
+            groups.setdefault(key, []).append(row_id)
+
+        self.needs_login = False
+        for (kind, target), row_ids in groups.items():
+            try:
+                mylist = self._send(kind, target)
+                if mylist:
+                    query.replace_mylist_placeholder(mylist)
+                self.sent += 1
+            except AniDBLoginError as e:
+                # No password to log in with from here (or a wrong one), the main thread has to log in
+                conn.rollback()
+                self.needs_login = True
+                print(f'Cannot log in to send MyList changes to AniDB, will retry: {e!r}')
+                return False
+            except (AniDBTimeout, OSError, sqlite3.OperationalError) as e:
+                conn.rollback()
+                print(f'Cannot send MyList changes to AniDB, will retry: {e!r}')
+                return False
+            except AniDBError as e:
+                if isinstance(e, AniDBReplyError) and _server_error(e):
+                    print(f'Cannot send MyList changes to AniDB, will retry: {e!r}')
+                    return False
+                # AniDB refused it, sending it again won't help
+                print(f'MyList change {kind} {target} rejected by AniDB: {e!r}')
+            try:
+                query.delete_outbox(row_ids)
+                conn.commit()
+            except sqlite3.OperationalError:
+                # Sent, but still queued, it's harmless to send again
+                conn.rollback()
+                return False
+        return True
+
+    def _send(self, kind: str, target: int) -> Optional[MyList]:
+        '''Send one change, returns the new MyList entry for an ADD_WATCHED'''
+        if kind == WATCHED:
+            self.anidb.mark_watched(Lid(target))
+            return None
+        result = self.anidb.add_mylist(Fid(target), viewed=True, storage=1)
+        if isinstance(result, MyList):
+            # Already in MyList
+            if not result.watched:
+                self.anidb.mark_watched(result.lid)
+            return self.anidb.get_mylist_lid(result.lid)
+        return self.anidb.get_mylist_lid(Lid(int(result[1][0])))
@@ -0,0 +1,152 @@
+"""
+Rate limiting of packets sent to AniDB
+
+AniDB's flood protection allows one packet every 2 seconds in the short term, but only one every 4
+seconds over an extended time, and bans clients that send faster.
+"""
+import abc
+import json
+import os
+import threading
+import time
+
+from typing import Dict, Optional
+
+
+# AniDB's short and long term limits, in seconds per packet
+SHORT_TERM_INTERVAL = 2.0
+LONG_TERM_INTERVAL = 4.0
+
+# Packets that can be sent without waiting after a break, 1 keeps every packet at least 2 seconds apart
+# Anything higher briefly sends faster than the short term limit, which AniDB can ban for
+DEFAULT_BURST = 1
+
+# Packets sent at the short term rate before dropping to the long term rate (about 10 minutes' worth)
+DEFAULT_SUSTAIN = 150
+
+
+class RateLimiter(abc.ABC):
+    """
+    Base for rate limiters, decides when each packet can be sent
+    Thread safe, wait sleeps until the packet can go, reserve leaves the waiting to the caller
+    """
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.waited = 0.0  # Total seconds packets were delayed
+        self.packets = 0
+
+    def reserve(self) -> float:
+        """Claim the next send slot, returns the seconds to wait before sending"""
+        with self.lock:
+            delay = self._reserve(time.time())
+            self.waited += delay
+            self.packets += 1
+            return delay
+
+    @abc.abstractmethod
+    def _reserve(self, now: float) -> float:
+        """Claim the next send slot at time now, returns the seconds to wait"""
+
+    def wait(self) -> float:
+        """Block until a packet can be sent, returns the seconds waited"""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+class FixedIntervalLimiter(RateLimiter):
+    """Sends at most one packet every interval seconds"""
+    def __init__(self, interval: float=SHORT_TERM_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self.next_time = 0.0
+
+    def _reserve(self, now: float) -> float:
+        send_time = max(now, self.next_time)
+        self.next_time = send_time + self.interval
+        return send_time - now
+
+
+class TokenBucket:
+    """
+    Holds up to capacity tokens, refilled at one per interval seconds
+    Tokens can be taken before they're available (going negative), so the wait for each is exact
+    """
+    def __init__(self, capacity: float, interval: float):
+        self.capacity = capacity
+        self.interval = interval
+        self.tokens = capacity
+        self.updated = 0.0
+
+    def _refill(self, now: float) -> None:
+        # A clock that went backwards adds nothing
+        elapsed = max(0.0, now - self.updated)
+        self.tokens = min(self.capacity, self.tokens + elapsed / self.interval)
+        self.updated = max(self.updated, now)
+
+    def take(self, now: float) -> float:
+        """Take a token, returns the seconds until it's available"""
+        self._refill(now)
+        self.tokens -= 1
+        return max(0.0, -self.tokens * self.interval)
+
+    def state(self) -> Dict[str, float]:
+        return {'tokens': self.tokens, 'updated': self.updated}
+
+    def restore(self, state: Dict[str, float]) -> None:
+        self.tokens = min(self.capacity, float(state['tokens']))
+        self.updated = float(state['updated'])
+
+
+class AniDBRateLimiter(RateLimiter):
+    """
+    AniDB's flood rules as two token buckets, a packet needs a token from both
+    Burst: after a break, up to burst packets go out at once, then one every 2 seconds (the default of 1
+    never sends faster than one every 2 seconds)
+    Sustain: once sustain packets have been sent at that rate, it slows to one every 4 seconds until it
+    has had a break
+    With state_file set, the buckets are saved after every packet and loaded on creation, so separate
+    runs of the program in quick succession share the limit
+    """
+    def __init__(self, burst: int=DEFAULT_BURST, sustain: int=DEFAULT_SUSTAIN, state_file: Optional[str]=None):
+        super().__init__()
+        self.short = TokenBucket(burst, SHORT_TERM_INTERVAL)
+        self.long = TokenBucket(sustain, LONG_TERM_INTERVAL)
+        self.state_file = state_file
+        if state_file:
+            self._load(state_file)
+
+    @property
+    def sustained(self) -> bool:
+        """Whether packets are currently limited to the long term rate"""
+        with self.lock:
+            self.long._refill(time.time())
+            return self.long.tokens < 1
+
+    def _reserve(self, now: float) -> float:
+        delay = max(self.short.take(now), self.long.take(now))
+        if self.state_file:
+            self._save(self.state_file)
+        return delay
+
+    def _load(self, path: str) -> None:
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            self.short.restore(state['short'])
+            self.long.restore(state['long'])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f'Ignoring bad rate limit state {path}: {e}')
+
+    def _save(self, path: str) -> None:
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'short': self.short.state(), 'long': self.long.state()}, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f'Cannot save rate limit state {path}: {e}')
@@ -0,0 +1,94 @@
+import concurrent.futures
+import os
+import time
+
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from tsubodb.types import DbRelPath
+
+
+# Directory mtimes this recent (ns) aren't trusted, a change in the same timestamp tick could be missed
+MTIME_GRACE_NS = 2 * 10**9
+
+
+class DirState:
+    def __init__(self, path: str, mtime_ns: int, entries: int, subdirs: List[str]):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.entries = entries
+        self.subdirs = subdirs  # Names, not paths
+
+    def __str__(self) -> str:
+        return f'{self.path}|mtime_ns={self.mtime_ns}|entries={self.entries}'
+
+
+def _scan_dir(path: str, suffixes: List[str], known: Optional[DirState]) -> Tuple[List[str], Optional[DirState], bool]:
+    """
+    List a single directory, returns (matching files, its state, whether the listing was skipped)
+    A directory's mtime changes whenever an entry is added, removed or renamed, so if it's the same as
+    last time there are no new files here (but subdirectories still need checking)
+    """
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+        if known and known.mtime_ns == mtime_ns:
+            return [], DirState(path, mtime_ns, known.entries, known.subdirs), True
+
+        files = []
+        subdirs = []
+        entries = 0
+        with os.scandir(path) as it:
+            for entry in it:
+                entries += 1
+                # DirEntry caches the type from the directory listing, so this doesn't stat each entry
+                if entry.is_dir():
+                    # Same as os.walk, don't descend into symlinked directories
+                    if not entry.is_symlink():
+                        subdirs.append(entry.name)
+                elif any(entry.name.endswith('.' + suffix) for suffix in suffixes):
+                    files.append(entry.path)
+    except OSError as e:
+        print(e)
+        return [], None, False
+
+    if time.time_ns() - mtime_ns < MTIME_GRACE_NS:
+        mtime_ns = -1
+    return files, DirState(path, mtime_ns, entries, subdirs), False
+
+
+def scan_tree(roots: Iterable[str], suffixes: List[str], known: Dict[DbRelPath, DirState], key: Callable[[str], DbRelPath],
+        num_threads: int=8) -> Tuple[List[str], List[DirState], int]:
+    """
+    Find files with one of the suffixes under roots, skipping the listing of directories unchanged since
+    the state in known (looked up by key(path))
+    Directories are read concurrently, which helps on high latency network mounts
+    Returns (files, state of every directory visited, number of directories skipped)
+    """
+    files: List[str] = []
+    states: List[DirState] = []
+    skipped = 0
+    seen: Set[str] = set()
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+        def submit(path: str) -> 'concurrent.futures.Future[Tuple[List[str], Optional[DirState], bool]]':
+            return executor.submit(_scan_dir, path, suffixes, known.get(key(path)))
+
+        pending = set()
+        for root in roots:
+            if root not in seen:
+                seen.add(root)
+                pending.add(submit(root))
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                new_files, state, was_skipped = future.result()
+                files += new_files
+                skipped += was_skipped
+                if state is None:
+                    continue
+                states.append(state)
+                for name in state.subdirs:
+                    sub = os.path.join(state.path, name)
+                    if sub not in seen:
+                        seen.add(sub)
+                        pending.add(submit(sub))
+    # Overlapping roots can find the same file twice
+    return sorted(set(files)), states, skipped
@@ -56,7 +56,7 @@ class MyList:
 
 
 class LocalEpisodeInfo():
-    def __init__(self, aid: Aid, fid: Fid, path: str, aname_e: str, epname_e: str, aname_r: str, epname_r: str, aname_k: str, epname_k: str, epno: str, epcode: str, epnomax: str, viewed: bool):
+    def __init__(self, aid: Aid, fid: Fid, path: str, aname_e: str, epname_e: str, aname_r: str, epname_r: str, aname_k: str, epname_k: str, epno: str, epcode: str, epnomax: str, viewed: bool, epnum: int = 0):
         self.aid = aid
         self.fid = fid
         self.path = path
@@ -70,6 +70,7 @@ class LocalEpisodeInfo():
         self.epcode = epcode
         self.epnomax = epnomax
         self.viewed = viewed
+        self.epnum = epnum  # epno without the epcode, as a number
 
     def __str__(self) -> str:
         return f'{self.aname_r} - ({self.epno}/{self.epnomax}) - {self.epname_r}'
@@ -0,0 +1,174 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# Seconds a file must be closed and untouched before it's considered complete
+DEFAULT_SETTLE = 10.0
+
+# (size, mtime_ns) of a file, to tell whether it has changed
+Signature = Tuple[int, int]
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, name length
+
+
+class Inotify:
+    """Minimal wrapper of the Linux inotify API through ctypes"""
+    def __init__(self) -> None:
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            self.libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError('inotify is not available on this system')
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return int(wd)
+
+    def read(self, timeout: Optional[float]) -> List[Tuple[int, int, str]]:
+        """Wait up to timeout seconds for events, returns (wd, mask, name) for each"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _cookie, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class DirectoryWatcher:
+    """
+    Watches a directory tree for video files that have finished being written
+    A file is ready once it has been closed (or moved in) and then left alone for settle seconds, so a
+    download that repeatedly reopens the file isn't picked up part way through
+    Files that never get a close event (hard or symbolic links, as made by e.g. Sonarr) are ready once their
+    size and mtime have stayed the same for settle seconds
+    """
+    def __init__(self, root: str, suffixes: List[str], settle: float=DEFAULT_SETTLE):
+        self.root = root
+        self.suffixes = suffixes
+        self.settle = settle
+        self.inotify = Inotify()
+        self.dirs: Dict[int, str] = dict()
+        # Path -> (time of last event or change, whether it has been closed since then, size and mtime then)
+        self.pending: Dict[str, Tuple[float, bool, Optional[Signature]]] = dict()
+        self._watch_tree(root, False)
+
+    def _matches(self, name: str) -> bool:
+        return any(name.endswith('.' + suffix) for suffix in self.suffixes)
+
+    def _watch_tree(self, path: str, add_existing: bool) -> None:
+        """Watch path and every directory in it, and if add_existing queue the files already there"""
+        now = time.monotonic()
+        for dirpath, _dirnames, filenames in os.walk(path, onerror=print):
+            try:
+                self.dirs[self.inotify.add_watch(dirpath, WATCH_MASK)] = dirpath
+            except OSError as e:
+                print(e)
+            if add_existing:
+                for name in filenames:
+                    if self._matches(name):
+                        self.pending[os.path.join(dirpath, name)] = (now, True, None)
+
+    def poll(self, timeout: Optional[float]=None) -> List[str]:
+        """Wait for events (up to timeout, default until a pending file could be ready), returns files now ready"""
+        if timeout is None:
+            timeout = self.next_timeout()
+        for wd, mask, name in self.inotify.read(timeout):
+            now = time.monotonic()
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so check everything again (already known files get filtered out later)
+                self._watch_tree(self.root, True)
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            if wd not in self.dirs:
+                continue
+            path = os.path.join(self.dirs[wd], name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files in a directory moved in (or written before the watch was added) have no events of their own
+                    self._watch_tree(path, True)
+            elif self._matches(name):
+                if mask & (IN_MOVED_FROM | IN_DELETE):
+                    self.pending.pop(path, None)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    self.pending[path] = (now, True, None)
+                elif mask & IN_CREATE:
+                    # A link is complete as soon as it's made, so note its state to see if it stays unchanged
+                    self.pending[path] = (now, False, self._signature(path))
+                elif mask & IN_MODIFY:
+                    self.pending[path] = (now, False, None)
+
+        now = time.monotonic()
+        ready = []
+        for path, (last, closed, signature) in list(self.pending.items()):
+            if now - last < self.settle:
+                continue
+            if closed:
+                ready.append(path)
+                continue
+            # Still open, or never written through this path, so only ready if it has stopped changing
+            current = self._signature(path)
+            if current is None:
+                del self.pending[path]
+            elif current == signature:
+                ready.append(path)
+            else:
+                self.pending[path] = (now, False, current)
+        for path in ready:
+            del self.pending[path]
+        return sorted(ready)
+
+    @staticmethod
+    def _signature(path: str) -> Optional[Signature]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def next_timeout(self) -> Optional[float]:
+        """Seconds until the next pending file could be ready, or None to wait indefinitely"""
+        if not self.pending:
+            return None
+        return max(0.0, min(last for last, _closed, _signature in self.pending.values()) + self.settle - time.monotonic())
+
+    def close(self) -> None:
+        self.inotify.close()